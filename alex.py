@@ -5,6 +5,8 @@ import chainer.functions as F
 from chainer import initializers
 import chainer.links as L
 
+from utils import inference
+
 
 class Alex(chainer.Chain):
 
@@ -25,7 +27,7 @@ class Alex(chainer.Chain):
         )
         self.train = True
 
-    def __call__(self, x, t):
+    def forward(self, x):
         h = F.max_pooling_2d(F.local_response_normalization(
             F.relu(self.conv1(x))), 3, stride=2)
         h = F.max_pooling_2d(F.local_response_normalization(
@@ -35,8 +37,84 @@ class Alex(chainer.Chain):
         h = F.max_pooling_2d(F.relu(self.conv5(h)), 3, stride=2)
         h = F.dropout(F.relu(self.fc6(h)), train=self.train)
         h = F.dropout(F.relu(self.fc7(h)), train=self.train)
-        h = self.fc8(h)
+        return self.fc8(h)
+
+    def __call__(self, x, t):
+        h = self.forward(x)
 
         loss = F.softmax_cross_entropy(h, t)
         chainer.report({'loss': loss, 'accuracy': F.accuracy(h, t)}, self)
         return loss
+
+    def predict(self, x):
+        """Class probabilities of a batch (array or Variable), with dropout
+        disabled and without building the backward graph."""
+        train = self.train
+        self.train = False
+        try:
+            return F.softmax(self.forward(inference.volatile(x))).data
+        finally:
+            self.train = train
+
+
+class AlexFCN(chainer.Chain):
+
+    """Fully-convolutional AlexNet for dense prediction on large images.
+
+    ``fc6``/``fc7``/``fc8`` of :class:`Alex` become a 6x6 and two 1x1
+    convolutions with the same weights, so an image of any size larger than
+    ``insize`` gives a score map in one forward pass: score ``(i, j)`` is
+    the output of ``Alex`` on the ``insize`` window at
+    ``(i * stride, j * stride)``, except that the padded convolutions see
+    the real neighbourhood of the window instead of zeros.
+    """
+
+    insize = 227
+    stride = 32
+
+    def __init__(self, n_out=1000):
+        super(AlexFCN, self).__init__(
+            conv1=L.Convolution2D(3,  96, 11, stride=4),
+            conv2=L.Convolution2D(96, 256,  5, pad=2),
+            conv3=L.Convolution2D(256, 384,  3, pad=1),
+            conv4=L.Convolution2D(384, 384,  3, pad=1),
+            conv5=L.Convolution2D(384, 256,  3, pad=1),
+            fc6=L.Convolution2D(256, 4096, 6),
+            fc7=L.Convolution2D(4096, 4096, 1),
+            fc8=L.Convolution2D(4096, n_out, 1),
+        )
+
+    @classmethod
+    def from_alex(cls, model):
+        """Builds the fully-convolutional network from trained ``Alex``
+        weights (``Linear`` weights are reshaped into kernels)."""
+        fcn = cls(model.fc8.W.data.shape[0])
+        for name in ('conv1', 'conv2', 'conv3', 'conv4', 'conv5',
+                     'fc6', 'fc7', 'fc8'):
+            src = getattr(model, name)
+            dst = getattr(fcn, name)
+            dst.W.data[...] = src.W.data.reshape(dst.W.data.shape)
+            dst.b.data[...] = src.b.data
+        return fcn
+
+    def __call__(self, x):
+        h = F.max_pooling_2d(F.local_response_normalization(
+            F.relu(self.conv1(x))), 3, stride=2)
+        h = F.max_pooling_2d(F.local_response_normalization(
+            F.relu(self.conv2(h))), 3, stride=2)
+        h = F.relu(self.conv3(h))
+        h = F.relu(self.conv4(h))
+        h = F.max_pooling_2d(F.relu(self.conv5(h)), 3, stride=2)
+        h = F.relu(self.fc6(h))
+        h = F.relu(self.fc7(h))
+        return self.fc8(h)
+
+    def predict(self, x):
+        """Class probability maps ``(N, n_out, rows, cols)`` of a batch,
+        cropped to the windows that lie fully inside the input (without
+        building the backward graph)."""
+        _, _, height, width = x.shape
+        rows = (height - self.insize) // self.stride + 1
+        cols = (width - self.insize) // self.stride + 1
+        scores = F.softmax(self(inference.volatile(x))).data
+        return scores[:, :, :rows, :cols]
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""Runs steps 1 to 3 on many scenes, each one in its own worker process.
+
+The manifest lists one scene per line: the geotiff, the shapefile of its
+parking lots and optionally a name (the geotiff name by default); relative
+paths are relative to the manifest, lines starting with # are ignored::
+
+    tiles/sao_paolo_r1c1.tif  lots/sao_paolo_r1c1.shp
+    tiles/sao_paolo_r1c2.tif  lots/sao_paolo_r1c2.shp  r1c2
+
+Every scene is processed by the fused pipeline of parkopedia.py in
+``<out>/<name>``, in a fresh process whose address space is limited to
+``--memory_mb``: a scene that fails (or runs out of memory) is reported and
+the batch goes on. Each finished scene records a status file, so running the
+same command again only processes the scenes that failed, were interrupted
+or whose inputs changed. Finally the training lists of the finished scenes
+are merged into ``<out>/training_labels.csv`` (for shards and records, a
+list of the scenes' cookie directories) and their statistics into
+``<out>/mean.npy`` and ``<out>/stats.npz``.
+"""
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import traceback
+
+import numpy as np
+
+
+status_name = 'status.json'
+error_name = 'error.txt'
+log_name = 'log.txt'
+
+
+def read_manifest(path):
+    """Returns the (name, raster, shapefile) of the scenes of a manifest."""
+    base = os.path.dirname(os.path.abspath(path))
+    scenes = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            raster, shp = [os.path.join(base, p) for p in fields[:2]]
+            name = (fields[2] if len(fields) > 2 else
+                    os.path.splitext(os.path.basename(raster))[0])
+            scenes.append((name, raster, shp))
+    names = [s[0] for s in scenes]
+    duplicates = sorted(set(n for n in names if names.count(n) > 1))
+    if duplicates:
+        raise ValueError('duplicate scene names in {}: {}'.format(
+            path, ', '.join(duplicates)))
+    return scenes
+
+
+def scene_key(raster, shp, params):
+    """What a scene's outputs depend on: the inputs (path, size and
+    modification time) and the parameters of the batch."""
+    from utils import stage_cache
+    files = []
+    for path in [raster] + stage_cache.shapefileParts(shp):
+        stat = os.stat(path)
+        files.append([os.path.abspath(path), stat.st_size, stat.st_mtime])
+    return {'files': files, 'params': params}
+
+
+def read_status(scene_dir):
+    try:
+        with open(os.path.join(scene_dir, status_name)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_status(scene_dir, status):
+    path = os.path.join(scene_dir, status_name)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(status, f)
+    os.rename(path + '.tmp', path)
+
+
+def _scene_worker(scene_dir, raster, shp, params, key, memory_mb,
+                  writer_processes):
+    # Runs in a fresh process: the step globals start from their defaults
+    # and all the memory of the scene is returned when it exits
+    if memory_mb:
+        limit = memory_mb * 2 ** 20
+        hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    os.chdir(scene_dir)
+    log = open(log_name, 'w')
+    sys.stdout = sys.stderr = log
+    start = time.time()
+    try:
+        import parkopedia
+        args = argparse.Namespace(
+            raster=raster, shapefile=shp, mask=None,
+            cookie_size=params['cookie_size'],
+            output_format=params['output_format'], save_mask=False,
+            mean='mean.npy', stats='stats.npz', profile='')
+        _, step2 = parkopedia._steps(args)
+        step2.writer_processes = writer_processes
+        moments = parkopedia.Pipeline(args).get('mean')
+        write_status(scene_dir, {
+            'status': 'done', 'key': key, 'cookies': int(moments.count),
+            'wall_time': time.time() - start})
+    except BaseException:
+        with open(error_name, 'w') as f:
+            f.write(traceback.format_exc())
+        traceback.print_exc()
+        log.flush()
+        os._exit(1)
+    # multiprocessing flushes the standard streams when the target returns
+    sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    log.close()
+
+
+def run_batch(scenes, output, params, workers=1, memory_mb=0,
+              writer_processes=1, poll=0.2):
+    """Processes the scenes that are not done yet with ``workers`` scenes
+    at a time. Returns the status of every scene, by name."""
+    statuses = {}
+    pending = []
+    for name, raster, shp in scenes:
+        scene_dir = os.path.abspath(os.path.join(output, name))
+        try:
+            key = scene_key(raster, shp, params)
+        except OSError as e:
+            statuses[name] = {'status': 'failed', 'error': str(e)}
+            print('{}: failed, {}'.format(name, e))
+            continue
+        status = read_status(scene_dir)
+        if status is not None and status['status'] == 'done' and status['key'] == key:
+            statuses[name] = status
+            print('{}: done already'.format(name))
+            continue
+        pending.append((name, scene_dir, raster, shp, key))
+
+    running = []
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                name, scene_dir, raster, shp, key = pending.pop(0)
+                if not os.path.exists(scene_dir):
+                    os.makedirs(scene_dir)
+                for stale in (status_name, error_name):
+                    if os.path.exists(os.path.join(scene_dir, stale)):
+                        os.remove(os.path.join(scene_dir, stale))
+                process = multiprocessing.Process(
+                    target=_scene_worker,
+                    args=(scene_dir, raster, shp, params, key, memory_mb,
+                          writer_processes))
+                process.start()
+                running.append((name, scene_dir, process))
+                print('{}: started'.format(name))
+            time.sleep(poll)
+            for name, scene_dir, process in list(running):
+                if process.is_alive():
+                    continue
+                process.join()
+                running.remove((name, scene_dir, process))
+                status = read_status(scene_dir)
+                if status is None or status['status'] != 'done':
+                    error = os.path.join(scene_dir, error_name)
+                    status = {'status': 'failed', 'exitcode': process.exitcode,
+                              'error': error if os.path.exists(error) else
+                              'killed (exit code {})'.format(process.exitcode)}
+                    write_status(scene_dir, status)
+                    print('{}: failed, {}'.format(name, status['error']))
+                else:
+                    print('{}: {} cookies in {:.1f} s'.format(
+                        name, status['cookies'], status['wall_time']))
+                statuses[name] = status
+    except KeyboardInterrupt:
+        # The interrupted scenes have no status: the next run redoes them
+        for _, _, process in running:
+            process.terminate()
+            process.join()
+        raise
+    return statuses
+
+
+def load_moments(path):
+    """Moments (see step3) of a scene, from the stats npz saved by its
+    mean stage."""
+    import step3_compute_mean as step3
+    stats = np.load(path)
+    moments = step3.Moments()
+    moments.count = int(stats['count'])
+    moments.mean = stats['mean'].astype(np.float64)
+    moments.channel_count = moments.count * moments.mean[0].size
+    moments.channel_mean = stats['channel_mean']
+    moments.channel_m2 = stats['channel_std'] ** 2 * moments.channel_count
+    return moments
+
+
+def merge_scenes(scenes, statuses, output, params):
+    """Merges the training lists and the statistics of the finished scenes,
+    in the order of the manifest. Returns the number of merged scenes."""
+    import step3_compute_mean as step3
+    cookie_folder = 'cookies_' + str(params['cookie_size'])
+    done = [name for name, _, _ in scenes
+            if statuses.get(name, {}).get('status') == 'done']
+    total = step3.Moments()
+    with open(os.path.join(output, 'training_labels.csv'), 'w') as merged:
+        for name in done:
+            scene_dir = os.path.abspath(os.path.join(output, name))
+            if params['output_format'] == 'png':
+                # The lists hold absolute paths: they are concatenated as is
+                with open(os.path.join(scene_dir, cookie_folder,
+                                       'training_labels.csv')) as f:
+                    merged.writelines(f)
+            else:
+                # A list of the scenes' shard or record directories, which
+                # datasets.openDataset reads as one concatenated dataset
+                merged.write(os.path.join(scene_dir, cookie_folder) + '\n')
+            total.merge(load_moments(os.path.join(scene_dir, 'stats.npz')))
+    if total.count:
+        np.save(os.path.join(output, 'mean.npy'), total.mean.astype(np.float32))
+        np.savez(os.path.join(output, 'stats.npz'),
+                 mean=total.mean.astype(np.float32),
+                 channel_mean=total.channel_mean,
+                 channel_std=total.channel_std, count=total.count)
+    return len(done)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Steps 1 to 3 on every scene of a manifest')
+    parser.add_argument('manifest',
+                        help='Text file with a "geotiff shapefile [name]" '
+                        'line per scene')
+    parser.add_argument('--out', '-o', default='scenes',
+                        help='Output directory (one folder per scene)')
+    parser.add_argument('--workers', '-j', type=int, default=1,
+                        help='Number of scenes processed at the same time')
+    parser.add_argument('--memory_mb', type=int, default=0,
+                        help='Address space limit of every worker, in MB '
+                        '(0 = no limit)')
+    parser.add_argument('--writer_processes', type=int, default=1,
+                        help='Processes encoding the PNG cookies of a scene')
+    parser.add_argument('--cookie_size', type=int, default=256)
+    parser.add_argument('--output_format', choices=['png', 'shards', 'records'],
+                        default='png')
+    args = parser.parse_args()
+
+    scenes = read_manifest(args.manifest)
+    if not os.path.exists(args.out):
+        os.makedirs(args.out)
+    params = {'cookie_size': args.cookie_size,
+              'output_format': args.output_format}
+    statuses = run_batch(scenes, args.out, params, args.workers,
+                         args.memory_mb, args.writer_processes)
+    with open(os.path.join(args.out, 'batch_report.json'), 'w') as f:
+        json.dump(statuses, f, indent=1, sort_keys=True)
+
+    merged = merge_scenes(scenes, statuses, args.out, params)
+    failed = sorted(name for name, status in statuses.items()
+                    if status['status'] != 'done')
+    print('{} scenes merged into {}, {} failed{}'.format(
+        merged, os.path.join(args.out, 'training_labels.csv'), len(failed),
+        ': ' + ', '.join(failed) if failed else ''))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import argparse
+import time
+
+import numpy as np
+
+import chainer
+
+import alex
+import googlenet
+import parkingnet
+
+
+def parameter_bytes(model):
+    return sum(param.data.nbytes for param in model.params()
+               if param.data is not None)
+
+
+def benchmark(model, batchsize=32, iterations=10):
+    """Images/sec of the inference forward pass and of a training
+    forward+backward pass on random data, and the parameter memory."""
+    x = np.random.uniform(
+        -1, 1, (batchsize, 3, model.insize, model.insize)).astype(np.float32)
+    t = np.random.randint(0, 2, batchsize).astype(np.int32)
+
+    # The first pass also initializes the lazily-sized layers
+    model.cleargrads()
+    model(chainer.Variable(x), chainer.Variable(t)).backward()
+
+    start = time.time()
+    for _ in range(iterations):
+        model.predict(x)
+    forward = batchsize * iterations / (time.time() - start)
+
+    start = time.time()
+    for _ in range(iterations):
+        model.cleargrads()
+        model(chainer.Variable(x), chainer.Variable(t)).backward()
+    backward = batchsize * iterations / (time.time() - start)
+
+    return forward, backward, parameter_bytes(model)
+
+
+def main():
+    archs = {
+        'alex': alex.Alex,
+        'googlenet': googlenet.GoogLeNet,
+        'parking_tiny': parkingnet.ParkingNetTiny,
+        'parking_small': parkingnet.ParkingNetSmall,
+        'parking_medium': parkingnet.ParkingNetMedium,
+    }
+
+    parser = argparse.ArgumentParser(
+        description='CPU throughput and memory of the convnets')
+    parser.add_argument('--arch', '-a', choices=archs.keys(), action='append',
+                        help='Architectures to benchmark (default: all)')
+    parser.add_argument('--batchsize', '-B', type=int, default=32,
+                        help='Minibatch size')
+    parser.add_argument('--iterations', '-i', type=int, default=10,
+                        help='Timed iterations per measure')
+    args = parser.parse_args()
+
+    print('{:16s} {:>12s} {:>12s} {:>10s}'.format(
+        'arch', 'fwd img/s', 'fwd+bwd img/s', 'params MB'))
+    for name in sorted(args.arch or archs.keys()):
+        forward, backward, nbytes = benchmark(
+            archs[name](), args.batchsize, args.iterations)
+        print('{:16s} {:12.1f} {:12.1f} {:10.1f}'.format(
+            name, forward, backward, nbytes / 2.0 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""Training throughput of ParallelUpdater from 1 to N worker processes.
+
+Every run trains the same model, from the same initial weights, on random
+images with the same global batch size; 1 worker is the StandardUpdater of
+step4. With --check the parameters after a few updates are compared with
+the single-process ones (dropout disabled). Run it with OMP_NUM_THREADS set
+to the cores per worker, e.g. 1, so that the workers do not compete for the
+BLAS threads::
+
+    OMP_NUM_THREADS=1 python benchmark_parallel.py --arch parking_small -N 16
+"""
+from __future__ import print_function
+import argparse
+import time
+
+import numpy as np
+
+import chainer
+from chainer import training
+
+import alex
+import googlenet
+import parallel_updater
+import parkingnet
+
+
+def make_model(arch, seed=0):
+    """The model with its lazily sized layers initialized from ``seed``."""
+    np.random.seed(seed)
+    model = arch()
+    x = np.zeros((1, 3, model.insize, model.insize), dtype=np.float32)
+    model(chainer.Variable(x, volatile='on'),
+          chainer.Variable(np.zeros(1, dtype=np.int32), volatile='on'))
+    return model
+
+
+def make_updater(model, batchsize, workers, seed=0):
+    rng = np.random.RandomState(seed)
+    x = rng.uniform(-1, 1, (4 * batchsize, 3, model.insize, model.insize))
+    t = rng.randint(0, 2, 4 * batchsize)
+    dataset = chainer.datasets.TupleDataset(x.astype(np.float32),
+                                            t.astype(np.int32))
+    train_iter = chainer.iterators.SerialIterator(dataset, batchsize,
+                                                  shuffle=False)
+    optimizer = chainer.optimizers.MomentumSGD(lr=0.01, momentum=0.9)
+    optimizer.setup(model)
+    if workers > 1:
+        return parallel_updater.ParallelUpdater(train_iter, optimizer, workers)
+    return training.StandardUpdater(train_iter, optimizer)
+
+
+def benchmark(arch, batchsize, workers, iterations):
+    """Images/sec of the training updates with ``workers`` processes."""
+    updater = make_updater(make_model(arch), batchsize, workers)
+    try:
+        updater.update()  # Warm up the workers and the memory pools
+        start = time.time()
+        for _ in range(iterations):
+            updater.update()
+        return batchsize * iterations / (time.time() - start)
+    finally:
+        updater.finalize()
+
+
+def check(arch, batchsize, workers, iterations=3):
+    """Largest difference between the parameters trained with ``workers``
+    processes and with one, relative to the largest parameter."""
+    params = []
+    for n in (1, workers):
+        model = make_model(arch)
+        model.train = False  # Same forward pass: no dropout
+        updater = make_updater(model, batchsize, n)
+        try:
+            for _ in range(iterations):
+                updater.update()
+        finally:
+            updater.finalize()
+        params.append(dict((name, param.data.copy())
+                           for name, param in model.namedparams()))
+    single, parallel = params
+    scale = max(np.abs(p).max() for p in single.values())
+    return max(np.abs(single[name] - parallel[name]).max()
+               for name in single) / scale
+
+
+def main():
+    archs = {
+        'alex': alex.Alex,
+        'googlenet': googlenet.GoogLeNet,
+        'parking_tiny': parkingnet.ParkingNetTiny,
+        'parking_small': parkingnet.ParkingNetSmall,
+        'parking_medium': parkingnet.ParkingNetMedium,
+    }
+
+    parser = argparse.ArgumentParser(
+        description='Scaling of data-parallel CPU training')
+    parser.add_argument('--arch', '-a', choices=archs.keys(),
+                        default='parking_small', help='Convnet architecture')
+    parser.add_argument('--batchsize', '-B', type=int, default=64,
+                        help='Global minibatch size')
+    parser.add_argument('--workers', '-N', type=int, default=4,
+                        help='Largest number of worker processes')
+    parser.add_argument('--iterations', '-i', type=int, default=10,
+                        help='Timed updates per measure')
+    parser.add_argument('--check', action='store_true',
+                        help='Compare the parameters trained with N workers '
+                        'and with one')
+    args = parser.parse_args()
+    arch = archs[args.arch]
+
+    if args.check:
+        error = check(arch, args.batchsize, args.workers)
+        print('{} workers: relative parameter difference {:.2e}'.format(
+            args.workers, error))
+
+    counts = sorted(set([1 << i for i in range(args.workers.bit_length())] +
+                        [args.workers]))
+    print('{:>8s} {:>12s} {:>9s} {:>11s}'.format(
+        'workers', 'img/s', 'speedup', 'efficiency'))
+    base = None
+    for workers in counts:
+        rate = benchmark(arch, args.batchsize, workers, args.iterations)
+        base = base or rate
+        print('{:8d} {:12.1f} {:8.2f}x {:10.0f}%'.format(
+            workers, rate, rate / base, 100 * rate / base / workers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+import numpy as np
+
+
+stage_names = ['get_polygons', 'label_parking_pixels', 'extract_cookies',
+               'save_images', 'compute_mean', 'train']
+
+# Stages that read the parking mask, and the training list of the cookies
+mask_stages = ['extract_cookies', 'save_images', 'compute_mean', 'train']
+list_stages = ['compute_mean', 'train']
+
+
+def make_scene(workdir, lines, pixels, num_polygons, seed=0):
+    """Writes a synthetic 4-band uint16 geotiff (UTM 23S, 0.5m pixels) and a
+    shapefile of ``num_polygons`` lon/lat parking lots inside it. Returns
+    their paths."""
+    import gdal
+    import osr
+    import shapefile
+    from utils import projection
+
+    rng = np.random.RandomState(seed)
+    geo_transform = (330000.0, 0.5, 0.0, 7400000.0, 0.0, -0.5)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32723)
+
+    # Random quadrilaterals in pixel coordinates, 10 to 80 pixels wide
+    centers = rng.uniform(0, 1, size=(num_polygons, 1, 2)) * [lines, pixels]
+    radius = rng.uniform(5, 40, size=(num_polygons, 1, 1))
+    angles = np.sort(rng.uniform(0, 2 * np.pi, size=(num_polygons, 4)), axis=1)
+    ring = centers + radius * np.dstack([np.sin(angles), np.cos(angles)])
+
+    scene_path = os.path.join(workdir, 'scene.tif')
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(scene_path, pixels, lines, 4, gdal.GDT_UInt16,
+                            ['TILED=YES', 'BIGTIFF=IF_SAFER'])
+    dataset.SetGeoTransform(geo_transform)
+    dataset.SetProjection(srs.ExportToWkt())
+    strip = 512
+    for line in range(0, lines, strip):
+        height = min(strip, lines - line)
+        for b in range(1, 5):
+            noise = rng.randint(200, 1200, size=(height, pixels))
+            dataset.GetRasterBand(b).WriteArray(noise.astype(np.uint16), 0, line)
+    dataset.FlushCache()
+    dataset = None
+
+    x = geo_transform[0] + ring[:, :, 1] * geo_transform[1]
+    y = geo_transform[3] + ring[:, :, 0] * geo_transform[5]
+    lon, lat = projection.worldToLonLat(x, y, srs.ExportToWkt())
+    lon = lon.reshape(num_polygons, -1)
+    lat = lat.reshape(num_polygons, -1)
+
+    shp_path = os.path.join(workdir, 'parking.shp')
+    version = int(getattr(shapefile, '__version__', '1').split('.')[0])
+    if version >= 2:
+        writer = shapefile.Writer(shp_path, shapeType=shapefile.POLYGON)
+    else:
+        writer = shapefile.Writer(shapefile.POLYGON)
+    writer.field('id', 'N', 10)
+    for i in range(num_polygons):
+        points = np.column_stack([lon[i], lat[i]]).tolist()
+        writer.poly([points + points[:1]])
+        writer.record(i)
+    if version >= 2:
+        writer.close()
+    else:
+        writer.save(shp_path)
+    return scene_path, shp_path
+
+
+def _configure(config, workdir):
+    # Point the module globals of step1 and step2 at the synthetic scene
+    import step1_preprocess_images as step1
+    import step2_segment_image as step2
+
+    step1.raster_data_path = step2.raster_data_path = config['scene']
+    step1.shp_data_path = config['shapefile']
+    step1.cookie_size = step2.cookie_size = config['cookie_size']
+    step2.cookie_overlap = config['cookie_size'] // 4
+    step2.parking_data_path = os.path.join(workdir, 'parking_matrix.pmask')
+    step2.polygon_index_path = os.path.join(workdir, 'parking_polygons.npz')
+    step2.output_folder = 'cookies'
+    step2.writer_processes = config['writer_processes']
+    # Always run the stages: no artifact cache
+    step1.cache_folder = step2.cache_folder = None
+    return step1, step2
+
+
+def _polygons(step1):
+    import shapefile
+
+    reader, geo_transform = step1.loadGeotiff()
+    sf = shapefile.Reader(step1.shp_data_path)
+    return reader, step1.getPolygons(sf, geo_transform, reader.projection)
+
+
+def _mask(step1, step2):
+    # Parking mask of the scene, computed by make_fixtures before the stages
+    from utils import mask_io
+
+    if not os.path.exists(step2.parking_data_path):
+        reader, polygons = _polygons(step1)
+        mask_io.saveMask(step2.parking_data_path,
+                         step1.labelParkingPixels(reader.shape, polygons))
+    return mask_io.openMask(step2.parking_data_path)
+
+
+def _select(step2, idx_to_label):
+    # Same balanced selection as step2's main
+    import random
+
+    random.seed(step2.random_seed)
+    positive = [i for i, j in enumerate(idx_to_label) if j == 1]
+    negative = [i for i, j in enumerate(idx_to_label) if j == 0]
+    random.shuffle(negative)
+    return negative, positive
+
+
+def _training_list(step1, step2):
+    path = os.path.join('cookies_' + str(step2.cookie_size),
+                        'training_labels.csv')
+    if not os.path.exists(path):
+        reader = step2.loadGeotiff()
+        cookies = step2.extractCookies(reader, _mask(step1, step2))
+        negative, positive = _select(step2, cookies[1])
+        step2.saveImages(negative, positive, cookies[2], cookies[1], reader,
+                         cookies[0])
+    return path
+
+
+def make_fixtures(config, step1, step2, stages):
+    """Writes the parking mask and the cookies that the stages read, so that
+    no stage pays for them."""
+    if set(stages) & set(mask_stages):
+        _mask(step1, step2)
+    if set(stages) & set(list_stages):
+        _training_list(step1, step2)
+    return {}
+
+
+def _rss_kb(field):
+    # VmRSS or VmHWM of this process in KB (Linux), None elsewhere
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def _maxrss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 if sys.platform == 'darwin' else peak  # bytes on OS X
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+class StageTimer(object):
+
+    """Measures the timed section of a stage (``with timer:``): wall time,
+    CPU time, and the growth of the resident memory over the section.
+
+    On Linux the high-water mark of the RSS is reset when the section
+    starts, so the growth is the section's peak minus the RSS at its start;
+    elsewhere it is the growth of the process high-water mark, a lower
+    bound.
+    """
+
+    def __enter__(self):
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            self._rss_start = _rss_kb('VmRSS')
+        except IOError:
+            self._rss_start = None
+        if self._rss_start is None:
+            self._rss_start = _maxrss_kb()
+            self._peak = _maxrss_kb
+        else:
+            self._peak = lambda: _rss_kb('VmHWM')
+        self._cpu_start = _cpu_time()
+        self._wall_start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall_time = time.time() - self._wall_start
+        self.cpu_time = _cpu_time() - self._cpu_start
+        self.rss_growth_mb = max(self._peak() - self._rss_start, 0) / 1024.0
+
+
+def bench_get_polygons(config, step1, step2, timer):
+    import shapefile
+
+    reader, geo_transform = step1.loadGeotiff()
+    sf = shapefile.Reader(step1.shp_data_path)
+    with timer:
+        polygons = step1.getPolygons(sf, geo_transform, reader.projection)
+    return len(polygons)
+
+
+def bench_label_parking_pixels(config, step1, step2, timer):
+    reader, polygons = _polygons(step1)
+    with timer:
+        step1.labelParkingPixels(reader.shape, polygons)
+    return len(polygons)
+
+
+def bench_extract_cookies(config, step1, step2, timer):
+    reader = step2.loadGeotiff()
+    mask = _mask(step1, step2)
+    with timer:
+        cookies = step2.extractCookies(reader, mask)
+    return len(cookies[0])
+
+
+def bench_save_images(config, step1, step2, timer):
+    reader = step2.loadGeotiff()
+    idx_to_coord, idx_to_label, idx_to_name, _ = step2.extractCookies(
+        reader, _mask(step1, step2))
+    negative, positive = _select(step2, idx_to_label)
+    with timer:
+        step2.saveImages(negative, positive, idx_to_name, idx_to_label,
+                         reader, idx_to_coord)
+    return 2 * len(positive)
+
+
+def bench_compute_mean(config, step1, step2, timer):
+    import step3_compute_mean as step3
+    from utils import datasets
+
+    dataset = datasets.openDataset(_training_list(step1, step2))
+    with timer:
+        step3.compute_mean(dataset)
+    return len(dataset)
+
+
+def bench_train(config, step1, step2, timer):
+    import chainer
+    import step4_train_imagenet as step4
+
+    path = _training_list(step1, step2)
+    archs = {
+        'alex': step4.alex.Alex,
+        'googlenet': step4.googlenet.GoogLeNet,
+        'parking_tiny': step4.parkingnet.ParkingNetTiny,
+        'parking_small': step4.parkingnet.ParkingNetSmall,
+        'parking_medium': step4.parkingnet.ParkingNetMedium,
+    }
+    model = archs[config['arch']]()
+    mean = np.zeros((3, step2.cookie_size, step2.cookie_size), dtype=np.float32)
+    train = step4.PreprocessedDataset(path, '.', mean, model.insize)
+    train_iter = chainer.iterators.SerialIterator(train, config['batchsize'])
+    optimizer = chainer.optimizers.MomentumSGD(lr=0.01, momentum=0.9)
+    optimizer.setup(model)
+    updater = chainer.training.StandardUpdater(train_iter, optimizer)
+
+    updater.update()  # The first iteration also initializes the model
+    with timer:
+        for _ in range(config['iterations']):
+            updater.update()
+    return config['iterations'] * config['batchsize']
+
+
+def _measure(config, step1, step2, stage):
+    timer = StageTimer()
+    items = globals()['bench_' + stage](config, step1, step2, timer)
+    return {'wall_time': timer.wall_time, 'cpu_time': timer.cpu_time,
+            'rss_growth_mb': timer.rss_growth_mb, 'items': items,
+            'items_per_sec': (items / timer.wall_time
+                              if timer.wall_time > 0 else 0.)}
+
+
+def _child(queue, func, config, workdir, args):
+    # Runs in a fresh process: a stage does not see the memory or the
+    # imports of the previous ones
+    try:
+        os.chdir(workdir)
+        step1, step2 = _configure(config, workdir)
+        queue.put(func(config, step1, step2, *args))
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+
+
+def _in_child(func, config, workdir, *args):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_child,
+                                      args=(queue, func, config, workdir, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def run_stage(stage, config, workdir):
+    return _in_child(_measure, config, workdir, stage)
+
+
+def run(config, stages, workdir, repeat=1):
+    """Builds the fixtures the stages read, then runs every stage ``repeat``
+    times, each time in a fresh process, and keeps the fastest run of each
+    stage."""
+    setup = _in_child(make_fixtures, config, workdir, stages)
+    if 'error' in setup:
+        raise RuntimeError('fixtures failed:\n' + setup['error'])
+    results = {}
+    for stage in stages:
+        runs = [run_stage(stage, config, workdir) for _ in range(repeat)]
+        errors = [r for r in runs if 'error' in r]
+        if errors:
+            print('{}: failed\n{}'.format(stage, errors[0]['error']))
+            results[stage] = errors[0]
+            continue
+        best = min(runs, key=lambda r: r['wall_time'])
+        best['rss_growth_mb'] = max(r['rss_growth_mb'] for r in runs)
+        results[stage] = best
+        print('{:22s} {:9.3f} s {:9.3f} s CPU {:9.1f} MB {:10.1f} items/s'
+              .format(stage, best['wall_time'], best['cpu_time'],
+                      best['rss_growth_mb'], best['items_per_sec']))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Stages whose wall time or memory growth increased by more than
+    ``tolerance`` (a fraction) with respect to the baseline results."""
+    regressions = []
+    for stage, result in sorted(results['stages'].items()):
+        base = baseline['stages'].get(stage)
+        if base is None or 'error' in base or 'error' in result:
+            continue
+        for key in ('wall_time', 'rss_growth_mb'):
+            if base.get(key, 0) > 0 and result[key] > base[key] * (1 + tolerance):
+                regressions.append((stage, key, base[key], result[key]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the pipeline stages on a synthetic scene')
+    parser.add_argument('--lines', type=int, default=4096,
+                        help='Height of the synthetic scene')
+    parser.add_argument('--pixels', type=int, default=4096,
+                        help='Width of the synthetic scene')
+    parser.add_argument('--polygons', type=int, default=500,
+                        help='Number of parking lots of the scene')
+    parser.add_argument('--cookie_size', type=int, default=256)
+    parser.add_argument('--writer_processes', type=int, default=None,
+                        help='PNG encoding processes of saveImages')
+    parser.add_argument('--arch', '-a', default='parking_tiny',
+                        choices=['alex', 'googlenet', 'parking_tiny',
+                                 'parking_small', 'parking_medium'],
+                        help='Convnet architecture of the train stage')
+    parser.add_argument('--batchsize', '-B', type=int, default=16,
+                        help='Minibatch size of the train stage')
+    parser.add_argument('--iterations', type=int, default=10,
+                        help='Timed training iterations')
+    parser.add_argument('--stages', nargs='+', choices=stage_names,
+                        default=stage_names, help='Stages to benchmark')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs per stage (the fastest is kept)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='Directory of the synthetic data '
+                        '(a temporary one, removed at the end, by default)')
+    parser.add_argument('--out', '-o', default='benchmark_results.json',
+                        help='JSON results file')
+    parser.add_argument('--compare', help='Baseline JSON results to flag '
+                        'slowdowns against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Allowed slowdown with --compare (0.1 = 10%%)')
+    args = parser.parse_args()
+
+    # The stage modules are imported from the child processes
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(
+        prefix='parkopedia_bench_'))
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+
+    try:
+        start = time.time()
+        scene, shp = make_scene(workdir, args.lines, args.pixels,
+                                args.polygons, args.seed)
+        print('synthetic scene {}x{}, {} polygons ({:.1f} s)'.format(
+            args.lines, args.pixels, args.polygons, time.time() - start))
+        config = {
+            'scene': scene, 'shapefile': shp, 'lines': args.lines,
+            'pixels': args.pixels, 'polygons': args.polygons,
+            'cookie_size': args.cookie_size,
+            'writer_processes': args.writer_processes, 'arch': args.arch,
+            'batchsize': args.batchsize, 'iterations': args.iterations,
+            'seed': args.seed,
+        }
+        stages = [s for s in stage_names if s in args.stages]
+        results = {
+            'config': dict((k, v) for k, v in config.items()
+                           if k not in ('scene', 'shapefile')),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': multiprocessing.cpu_count(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'stages': run(config, stages, workdir, args.repeat),
+        }
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('results saved to', args.out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != results['config']:
+            print('warning: the baseline was run with a different config')
+        regressions = compare(results, baseline, args.tolerance)
+        for stage, key, before, after in regressions:
+            print('REGRESSION {}: {} {:.3f} -> {:.3f} ({:+.0%})'.format(
+                stage, key, before, after, after / before - 1))
+        if regressions:
+            sys.exit(1)
+        print('no regression over {:.0%} against {}'.format(
+            args.tolerance, args.compare))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,8 @@ import chainer.functions as F
 import chainer.links as L
 import pdb
 
+from utils import inference
+
 
 class GoogLeNet(chainer.Chain):
 
@@ -34,7 +36,9 @@ class GoogLeNet(chainer.Chain):
         )
         self.train = True
 
-    def __call__(self, x, t):
+    def forward(self, x, aux=True):
+        """Returns the logits of the main classifier and, if aux is True,
+        of the two auxiliary classifiers (None otherwise)."""
         h = F.relu(self.conv1(x))
         h = F.local_response_normalization(
             F.max_pooling_2d(h, 3, stride=2), n=5)
@@ -48,21 +52,23 @@ class GoogLeNet(chainer.Chain):
         h = F.max_pooling_2d(h, 3, stride=2)
         h = self.inc4a(h)
 
-        l = F.average_pooling_2d(h, 5, stride=3)
-        l = F.relu(self.loss1_conv(l))
-        l = F.relu(self.loss1_fc1(l))
-        l = self.loss1_fc2(l)
-        loss1 = F.softmax_cross_entropy(l, t)
+        l1 = None
+        if aux:
+            l = F.average_pooling_2d(h, 5, stride=3)
+            l = F.relu(self.loss1_conv(l))
+            l = F.relu(self.loss1_fc1(l))
+            l1 = self.loss1_fc2(l)
 
         h = self.inc4b(h)
         h = self.inc4c(h)
         h = self.inc4d(h)
 
-        l = F.average_pooling_2d(h, 5, stride=3)
-        l = F.relu(self.loss2_conv(l))
-        l = F.relu(self.loss2_fc1(l))
-        l = self.loss2_fc2(l)
-        loss2 = F.softmax_cross_entropy(l, t)
+        l2 = None
+        if aux:
+            l = F.average_pooling_2d(h, 5, stride=3)
+            l = F.relu(self.loss2_conv(l))
+            l = F.relu(self.loss2_fc1(l))
+            l2 = self.loss2_fc2(l)
 
         h = self.inc4e(h)
         h = F.max_pooling_2d(h, 3, stride=2)
@@ -71,6 +77,24 @@ class GoogLeNet(chainer.Chain):
 
         h = F.average_pooling_2d(h, 7, stride=1)
         h = self.loss3_fc(F.dropout(h, 0.4, train=self.train))
+        return h, l1, l2
+
+    def __call__(self, x, t):
+        if not self.train:
+            # Evaluation (e.g. TestModeEvaluator): the auxiliary classifiers
+            # are only used as a training signal, skip them
+            h, _, _ = self.forward(x, aux=False)
+            loss3 = F.softmax_cross_entropy(h, t)
+            chainer.report({
+                'loss': loss3,
+                'loss3': loss3,
+                'accuracy': F.accuracy(h, t)
+            }, self)
+            return loss3
+
+        h, l1, l2 = self.forward(x)
+        loss1 = F.softmax_cross_entropy(l1, t)
+        loss2 = F.softmax_cross_entropy(l2, t)
         loss3 = F.softmax_cross_entropy(h, t)
 
         loss = 0.3 * (loss1 + loss2) + loss3
@@ -84,3 +108,15 @@ class GoogLeNet(chainer.Chain):
             'accuracy': accuracy
         }, self)
         return loss
+
+    def predict(self, x):
+        """Class probabilities of a batch (array or Variable) from the main
+        classifier only, with dropout disabled and without building the
+        backward graph."""
+        train = self.train
+        self.train = False
+        try:
+            h, _, _ = self.forward(inference.volatile(x), aux=False)
+            return F.softmax(h).data
+        finally:
+            self.train = train
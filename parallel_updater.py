@@ -0,0 +1,223 @@
+from __future__ import print_function
+import multiprocessing
+import traceback
+
+import numpy as np
+
+import chainer
+from chainer import training
+
+
+def _context():
+    # Workers must be forked: they inherit the model and the shared buffers
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+
+def _shared(ctx, shape, dtype=np.float32):
+    """Zero-filled array in shared memory, visible to forked children."""
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    buf = ctx.RawArray('b', max(size * dtype.itemsize, 1))
+    return np.frombuffer(buf, dtype=dtype, count=size).reshape(shape)
+
+
+class _Failure(object):
+
+    def __init__(self, message):
+        self.message = message
+
+
+class ParallelUpdater(training.StandardUpdater):
+
+    """Data-parallel updater for CPU training on ``workers`` processes.
+
+    Every step the global batch is split into ``workers`` contiguous shards:
+    the updater's process computes the first one and each forked worker,
+    holding a replica of the model, one of the others. The parameters live in
+    shared memory, so the replicas see every update of the optimizer without
+    copies; every worker writes the gradient of its shard, weighted by the
+    shard size, to its row of a shared buffer, and the rows are summed by all
+    the workers, each one over a slice of the parameters. The summed
+    gradient is the gradient of the loss averaged over the whole batch, so an
+    update is the one ``StandardUpdater`` makes on the same batch (up to
+    floating point rounding, and to the random dropout masks).
+
+    The shared gradients take ``workers + 1`` times the parameter memory.
+    Only the optimizer of the updater's process has a state. The persistent
+    values of the replicas (e.g. batch normalization statistics) are not
+    synchronized. The observations (e.g. ``main/loss``) are reported as
+    floats averaged over the shards, without a computational graph.
+    """
+
+    def __init__(self, iterator, optimizer, workers,
+                 converter=chainer.dataset.concat_examples):
+        super(ParallelUpdater, self).__init__(iterator, optimizer,
+                                              converter=converter)
+        model = optimizer.target
+        self.workers = workers
+        batchsize = self._iterators['main'].batch_size
+
+        # The lazily sized layers get their parameters from a first forward
+        if any(param.data is None for param in model.params()):
+            x = np.zeros((1, 3, model.insize, model.insize), dtype=np.float32)
+            model(chainer.Variable(x, volatile='on'),
+                  chainer.Variable(np.zeros(1, dtype=np.int32), volatile='on'))
+
+        # Parameters, in a fixed order, as views of one shared vector
+        self._params = [param for _, param in sorted(model.namedparams())]
+        sizes = [param.data.size for param in self._params]
+        self._offsets = np.cumsum([0] + sizes)
+        ctx = _context()
+        flat = _shared(ctx, (self._offsets[-1],))
+        for param, start, stop in zip(self._params, self._offsets[:-1],
+                                      self._offsets[1:]):
+            flat[start:stop] = param.data.ravel()
+            param.data = flat[start:stop].reshape(param.data.shape)
+        self._grads = _shared(ctx, (workers, self._offsets[-1]))
+        self._total = _shared(ctx, (self._offsets[-1],))
+
+        self._x = _shared(ctx, (batchsize, 3, model.insize, model.insize))
+        self._t = _shared(ctx, (batchsize,), np.int32)
+        self._reporter = chainer.Reporter()
+        self._reporter.add_observer('main', model)
+
+        # Every replica draws its own dropout masks
+        seeds = np.random.randint(0, 2 ** 31, size=workers)
+        self._conns = []
+        self._processes = []
+        for k in range(1, workers):
+            conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=self._worker,
+                                  args=(k, child_conn, seeds[k]))
+            process.daemon = True
+            process.start()
+            # Only the worker holds the other end: if it dies, recv gets EOF
+            child_conn.close()
+            self._conns.append(conn)
+            self._processes.append(process)
+
+    def _shard(self, k, n):
+        bounds = np.linspace(0, n, self.workers + 1).astype(int)
+        return bounds[k], bounds[k + 1]
+
+    def _backward(self, k, n):
+        # Gradient of the loss of shard k, weighted by its share of the batch
+        model = self.get_optimizer('main').target
+        lo, hi = self._shard(k, n)
+        if lo == hi:
+            self._grads[k] = 0
+            return {}, 0
+        model.cleargrads()
+        observation = {}
+        with self._reporter.scope(observation):
+            loss = model(chainer.Variable(self._x[lo:hi]),
+                         chainer.Variable(self._t[lo:hi]))
+        (loss * ((hi - lo) / float(n))).backward()
+        for param, start, stop in zip(self._params, self._offsets[:-1],
+                                      self._offsets[1:]):
+            if param.grad is None:
+                self._grads[k, start:stop] = 0
+            else:
+                self._grads[k, start:stop] = param.grad.ravel()
+        observation = dict(
+            (key, float(value.data if isinstance(value, chainer.Variable)
+                        else value))
+            for key, value in observation.items())
+        return observation, hi - lo
+
+    def _reduce(self, k):
+        # Sum of the gradients of all the shards over a slice of parameters
+        lo, hi = self._shard(k, len(self._total))
+        self._total[lo:hi] = self._grads[:, lo:hi].sum(axis=0)
+
+    def _worker(self, k, conn, seed):
+        np.random.seed(seed)
+        while True:
+            message = conn.recv()
+            if message is None:
+                return
+            try:
+                if message[0] == 'backward':
+                    conn.send(self._backward(k, message[1]))
+                else:
+                    self._reduce(k)
+                    conn.send(None)
+            except Exception:
+                conn.send(_Failure(traceback.format_exc()))
+
+    def _died(self, k):
+        process = self._processes[k - 1]
+        process.join(1.0)
+        return RuntimeError('training worker {} died (exit code {})'.format(
+            k, process.exitcode))
+
+    def _send(self, k, message):
+        try:
+            self._conns[k - 1].send(message)
+        except (IOError, OSError):
+            raise self._died(k)
+
+    def _receive(self, k):
+        # A worker killed (e.g. out of memory) without sending anything is
+        # noticed by its exit or by the end of its pipe
+        conn, process = self._conns[k - 1], self._processes[k - 1]
+        try:
+            while not conn.poll(1.0):
+                if not process.is_alive():
+                    raise EOFError
+            result = conn.recv()
+        except EOFError:
+            raise self._died(k)
+        if isinstance(result, _Failure):
+            raise RuntimeError('training worker failed:\n' + result.message)
+        return result
+
+    def update_core(self):
+        batch = self._iterators['main'].next()
+        x, t = self.converter(batch, -1)
+        n = len(x)
+        if n > len(self._x) or x.shape[1:] != self._x.shape[1:]:
+            raise ValueError('batch of shape {} does not fit the buffer of '
+                             'shape {}'.format(x.shape, self._x.shape))
+        self._x[:n] = x
+        self._t[:n] = t
+
+        for k in range(1, self.workers):
+            self._send(k, ('backward', n))
+        results = [self._backward(0, n)]
+        results += [self._receive(k) for k in range(1, self.workers)]
+
+        for k in range(1, self.workers):
+            self._send(k, ('reduce',))
+        self._reduce(0)
+        for k in range(1, self.workers):
+            self._receive(k)
+
+        for param, start, stop in zip(self._params, self._offsets[:-1],
+                                      self._offsets[1:]):
+            param.grad = self._total[start:stop].reshape(param.data.shape)
+        optimizer = self.get_optimizer('main')
+        optimizer.update()
+
+        # Observations of the shards, averaged over the batch
+        observation = {}
+        for shard_observation, size in results:
+            for key, value in shard_observation.items():
+                observation[key] = observation.get(key, 0.) + value * size / float(n)
+        chainer.report(dict((key.split('/', 1)[-1], value)
+                            for key, value in observation.items()),
+                       optimizer.target)
+
+    def finalize(self):
+        for conn in self._conns:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass  # The worker is dead already
+        for process in self._processes:
+            process.join()
+        self._conns = []
+        self._processes = []
+        super(ParallelUpdater, self).finalize()
@@ -0,0 +1,72 @@
+import chainer
+import chainer.functions as F
+import chainer.links as L
+
+from utils import inference
+
+
+class ParkingNet(chainer.Chain):
+
+    """Small binary parking / no-parking classifier for 256px cookies.
+
+    Four conv-relu-pool stages (the first one strided) take the 224px crop
+    down to 7x7, followed by global average pooling and a two-way linear
+    classifier. ``width`` is the number of channels of the first stage and
+    doubles at every stage.
+    """
+
+    insize = 224
+
+    def __init__(self, width=32):
+        super(ParkingNet, self).__init__(
+            conv1=L.Convolution2D(3, width, 5, stride=2, pad=2),
+            conv2=L.Convolution2D(width, 2 * width, 3, pad=1),
+            conv3=L.Convolution2D(2 * width, 4 * width, 3, pad=1),
+            conv4=L.Convolution2D(4 * width, 8 * width, 3, pad=1),
+            fc=L.Linear(8 * width, 2),
+        )
+        self.train = True
+
+    def forward(self, x):
+        h = F.max_pooling_2d(F.relu(self.conv1(x)), 2, stride=2)
+        h = F.max_pooling_2d(F.relu(self.conv2(h)), 2, stride=2)
+        h = F.max_pooling_2d(F.relu(self.conv3(h)), 2, stride=2)
+        h = F.max_pooling_2d(F.relu(self.conv4(h)), 2, stride=2)
+        h = F.average_pooling_2d(h, h.data.shape[2:])
+        h = F.dropout(h, 0.5, train=self.train)
+        return self.fc(h)
+
+    def __call__(self, x, t):
+        h = self.forward(x)
+
+        loss = F.softmax_cross_entropy(h, t)
+        chainer.report({'loss': loss, 'accuracy': F.accuracy(h, t)}, self)
+        return loss
+
+    def predict(self, x):
+        """Class probabilities of a batch (array or Variable), with dropout
+        disabled and without building the backward graph."""
+        train = self.train
+        self.train = False
+        try:
+            return F.softmax(self.forward(inference.volatile(x))).data
+        finally:
+            self.train = train
+
+
+class ParkingNetTiny(ParkingNet):
+
+    def __init__(self):
+        super(ParkingNetTiny, self).__init__(16)
+
+
+class ParkingNetSmall(ParkingNet):
+
+    def __init__(self):
+        super(ParkingNetSmall, self).__init__(32)
+
+
+class ParkingNetMedium(ParkingNet):
+
+    def __init__(self):
+        super(ParkingNetMedium, self).__init__(64)
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""Single entry point of the pipeline.
+
+``run`` executes steps 1 to 3 in one process as a graph of stages that hand
+their results over in memory: the geotiff is opened once, the parking mask
+goes from the rasterizer to the cookie extraction without a round trip
+through disk, and the mean image is accumulated while the cookies are
+written instead of decoding them again. The other commands run a single
+step with its own arguments::
+
+    python parkopedia.py run --raster scene.tif --shapefile lots.shp
+    python parkopedia.py stages
+    python parkopedia.py preprocess --raster scene.tif --shapefile lots.shp
+    python parkopedia.py segment --raster scene.tif --cookie_size 128
+    python parkopedia.py mean cookies_256/training_labels.csv
+    python parkopedia.py train train.txt val.txt --arch parking_small
+    python parkopedia.py predict scene.tif result/model_iter_1000
+    python parkopedia.py batch scenes.txt --workers 8 --memory_mb 16000
+
+The steps are imported by the command that needs them, so GDAL, Chainer and
+matplotlib are only loaded when used.
+"""
+from __future__ import print_function
+import argparse
+import collections
+import random
+import sys
+
+import numpy as np
+
+from utils import profiling
+
+
+stages = collections.OrderedDict()
+
+
+def stage(name, *deps):
+    """Registers a stage of ``run``: a function of the parsed arguments and of
+    the results of the stages ``deps``, in that order."""
+    def decorator(func):
+        stages[name] = (deps, func)
+        return func
+    return decorator
+
+
+class Pipeline(object):
+
+    """Runs the stages a target depends on, each one once, and keeps their
+    results in memory for the stages downstream."""
+
+    def __init__(self, args):
+        self.args = args
+        self.results = {}
+
+    def get(self, name):
+        if name not in self.results:
+            deps, func = stages[name]
+            inputs = [self.get(dep) for dep in deps]
+            with profiling.stage('run.' + name):
+                self.results[name] = func(self.args, *inputs)
+        return self.results[name]
+
+
+class MomentsAccumulator(object):
+
+    """Mean image and channel statistics of the cookies, fed one uint8 HWC
+    cookie at a time as it is written. The cookies are reduced in chunks as
+    step3 does, so the mean is the one compute_mean.py gets from the saved
+    cookies (PNG is lossless), up to the rounding of the summation order."""
+
+    def __init__(self, chunk_size=32):
+        import step3_compute_mean as step3
+        self.moments_class = step3.Moments
+        self.chunk_size = chunk_size
+        self.total = step3.Moments()
+        self.chunk = []
+
+    def add(self, cookie):
+        self.chunk.append(cookie.transpose(2, 0, 1))
+        if len(self.chunk) == self.chunk_size:
+            self._reduce()
+
+    def _reduce(self):
+        self.total.merge(self.moments_class(self.chunk))
+        self.chunk = []
+
+    def close(self):
+        self._reduce()
+        return self.total
+
+
+def _steps(args):
+    """Imports steps 1 and 2 and applies the arguments given to their
+    global variables."""
+    import step1_preprocess_images as step1
+    import step2_segment_image as step2
+    if args.raster is not None:
+        step1.raster_data_path = step2.raster_data_path = args.raster
+    if getattr(args, 'shapefile', None) is not None:
+        step1.shp_data_path = args.shapefile
+    if getattr(args, 'mask', None) is not None:
+        step1.mask_path = step2.parking_data_path = args.mask
+    if getattr(args, 'cookie_size', None) is not None:
+        step1.cookie_size = step2.cookie_size = args.cookie_size
+        step2.cookie_overlap = args.cookie_size // 4
+    if getattr(args, 'output_format', None) is not None:
+        step2.output_format = args.output_format
+    return step1, step2
+
+
+@stage('raster')
+def load_raster(args):
+    """Opens the geotiff once (windowed reader and geo-transformation)."""
+    step1, _ = _steps(args)
+    return step1.loadGeotiff()
+
+
+@stage('polygons', 'raster')
+def get_polygons(args, raster):
+    """Reads the shapefile and projects the lots to pixel coordinates."""
+    import shapefile
+    step1, _ = _steps(args)
+    image_array_RGB, geo_transform = raster
+    return step1.getPolygons(shapefile.Reader(step1.shp_data_path),
+                             geo_transform, image_array_RGB.projection)
+
+
+@stage('mask', 'raster', 'polygons')
+def label_pixels(args, raster, polygons):
+    """Rasterizes the lots (also saved with --save_mask)."""
+    from utils import mask_io
+    step1, step2 = _steps(args)
+    parking_matrix = step1.labelParkingPixels(raster[0].shape, polygons)
+    if args.save_mask:
+        mask_io.saveMask(step1.mask_path, parking_matrix)
+        step2.parking_data_path = step1.mask_path
+    return parking_matrix
+
+
+@stage('lots', 'polygons')
+def index_lots(args, polygons):
+    """Spatial index of the lots, for the lots column of the coverage csv."""
+    from utils import polygon_index
+    step1, step2 = _steps(args)
+    lots_index = polygon_index.PolygonIndex(polygons)
+    lots_index.save(step1.index_path)
+    step2.polygon_index_path = step1.index_path
+    return lots_index
+
+
+@stage('cookies', 'raster', 'mask', 'lots')
+def save_cookies(args, raster, parking_matrix, lots_index):
+    """Saves the cookies and accumulates their moments as they are written.
+
+    Returns None for the records, which have no cookie to accumulate."""
+    _, step2 = _steps(args)
+    image_array_RGB = raster[0]
+    np.random.seed(step2.random_seed)
+    random.seed(step2.random_seed)
+
+    if step2.output_format == 'records':
+        step2.saveRecords(image_array_RGB.shape, parking_matrix)
+        return None
+
+    idx_to_coord, idx_to_label, idx_to_name, idx_to_coverage = step2.extractCookies(
+        image_array_RGB, parking_matrix)
+    positive_cookies = [i for i, j in enumerate(idx_to_label) if j == 1]
+    negative_cookies = [i for i, j in enumerate(idx_to_label) if j == 0]
+    random.shuffle(negative_cookies)
+
+    accumulator = MomentsAccumulator()
+    save = step2.saveShards if step2.output_format == 'shards' else step2.saveImages
+    save(negative_cookies, positive_cookies, idx_to_name, idx_to_label,
+         image_array_RGB, idx_to_coord, callback=accumulator.add)
+    step2.saveCoverage(idx_to_name, idx_to_coverage, lots_index)
+    return accumulator.close()
+
+
+@stage('mean', 'cookies')
+def save_mean(args, moments):
+    """Saves the mean image (and the channel statistics with --stats)."""
+    if moments is None:
+        # Virtual cookies are cropped from the geotiff: one pass over them
+        import step3_compute_mean as step3
+        from utils import datasets
+        _, step2 = _steps(args)
+        output_path = step2.output_folder + '_' + str(step2.cookie_size)
+        moments = step3.compute_statistics(datasets.openDataset(output_path))
+    np.save(args.mean, moments.mean.astype(np.float32))
+    print('{} images, channel mean {}, channel std {}'.format(
+        moments.count, moments.channel_mean, moments.channel_std))
+    if args.stats:
+        np.savez(args.stats, mean=moments.mean.astype(np.float32),
+                 channel_mean=moments.channel_mean,
+                 channel_std=moments.channel_std, count=moments.count)
+    return moments
+
+
+def _step_parser(prog, description):
+    parser = argparse.ArgumentParser(prog=prog, description=description)
+    parser.add_argument('--raster', help='Geotiff of the scene')
+    parser.add_argument('--mask', help='Parking mask written by step 1')
+    parser.add_argument('--profile', default='',
+                        help='Write the time and memory of every stage to '
+                        'this file (Chrome trace if it ends with .json)')
+    return parser
+
+
+def run(argv):
+    parser = _step_parser('parkopedia.py run',
+                          'Steps 1 to 3 in one process, sharing the data in memory')
+    parser.add_argument('--shapefile', help='Shapefile of the parking lots')
+    parser.add_argument('--cookie_size', type=int)
+    parser.add_argument('--output_format', choices=['png', 'shards', 'records'])
+    parser.add_argument('--save_mask', action='store_true',
+                        help='Also save the parking mask (for step 2 alone)')
+    parser.add_argument('--mean', default='mean.npy',
+                        help='Path of the mean image')
+    parser.add_argument('--stats', default='',
+                        help='Path of an npz with the mean and the channel statistics')
+    parser.add_argument('--target', choices=list(stages), default='mean',
+                        help='Last stage to run')
+    args = parser.parse_args(argv)
+    if args.profile:
+        profiling.enable(args.profile)
+    Pipeline(args).get(args.target)
+
+
+def show_stages(argv):
+    for name, (deps, func) in stages.items():
+        print('{:10s} <- {:24s} {}'.format(name, ', '.join(deps) or '-',
+                                           func.__doc__.split('\n')[0]))
+
+
+def preprocess(argv):
+    parser = _step_parser('parkopedia.py preprocess', 'Step 1: parking mask')
+    parser.add_argument('--shapefile', help='Shapefile of the parking lots')
+    args = parser.parse_args(argv)
+    if args.profile:
+        profiling.enable(args.profile)
+    step1, _ = _steps(args)
+    step1.main()
+
+
+def segment(argv):
+    parser = _step_parser('parkopedia.py segment', 'Step 2: cookies')
+    parser.add_argument('--cookie_size', type=int)
+    parser.add_argument('--output_format', choices=['png', 'shards', 'records'])
+    args = parser.parse_args(argv)
+    if args.profile:
+        profiling.enable(args.profile)
+    _, step2 = _steps(args)
+    step2.main()
+
+
+def _forward(module_name, command):
+    """A command that hands its arguments to the main() of a step."""
+    def forward(argv):
+        module = __import__(module_name)
+        sys.argv = ['parkopedia.py ' + command] + list(argv)
+        module.main()
+    return forward
+
+
+commands = collections.OrderedDict([
+    ('run', run),
+    ('stages', show_stages),
+    ('preprocess', preprocess),
+    ('segment', segment),
+    ('mean', _forward('step3_compute_mean', 'mean')),
+    ('train', _forward('step4_train_imagenet', 'train')),
+    ('predict', _forward('step5_predict_scene', 'predict')),
+    ('batch', _forward('batch_scenes', 'batch')),
+])
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in commands:
+        print('usage: parkopedia.py {%s} ...' % ','.join(commands),
+              file=sys.stderr)
+        return 2
+    commands[argv[0]](argv[1:])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
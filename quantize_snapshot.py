@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import argparse
+import copy
+
+import numpy as np
+
+import chainer
+
+import alex
+import googlenet
+import parkingnet
+import quantized
+from utils import datasets
+
+
+def evaluate(model, dataset, mean, batchsize=64):
+    """Class probabilities of the center crops of a dataset and their
+    labels."""
+    crop_size = model.insize
+    probs, labels = [], []
+    for start in range(0, len(dataset), batchsize):
+        batch = [dataset[i]
+                 for i in range(start, min(start + batchsize, len(dataset)))]
+        x = np.stack([image for image, _ in batch])
+        _, _, h, w = x.shape
+        top = (h - crop_size) // 2
+        left = (w - crop_size) // 2
+        x = x[:, :, top:top + crop_size, left:left + crop_size]
+        x -= mean[:, top:top + crop_size, left:left + crop_size]
+        x *= (1.0 / 255.0)
+
+        probs.append(model.predict(x))
+        labels.extend(label for _, label in batch)
+    return np.concatenate(probs), np.asarray(labels)
+
+
+def main():
+    archs = {
+        'alex': alex.Alex,
+        'googlenet': googlenet.GoogLeNet,
+        'parking_tiny': parkingnet.ParkingNetTiny,
+        'parking_small': parkingnet.ParkingNetSmall,
+        'parking_medium': parkingnet.ParkingNetMedium,
+    }
+
+    parser = argparse.ArgumentParser(
+        description='Int8 per-channel quantization of a trained model, '
+        'to store and load it in about a quarter of the memory')
+    parser.add_argument('model', help='Trained model (snapshot_object npz)')
+    parser.add_argument('--arch', '-a', choices=archs.keys(), default='alex',
+                        help='Convnet architecture')
+    parser.add_argument('--out', '-o', default='model_int8.npz',
+                        help='Output quantized model')
+    parser.add_argument('--val', help='Validation list to compare the '
+                        'accuracy of the float and quantized models')
+    parser.add_argument('--root', '-R', default='.',
+                        help='Root directory path of image files')
+    parser.add_argument('--mean', '-m', default='mean.npy',
+                        help='Mean file (computed by compute_mean.py)')
+    parser.add_argument('--batchsize', '-B', type=int, default=64,
+                        help='Validation minibatch size')
+    args = parser.parse_args()
+
+    model = archs[args.arch]()
+    chainer.serializers.load_npz(args.model, model)
+    model.train = False
+
+    qmodel = quantized.quantize_model(copy.deepcopy(model))
+    chainer.serializers.save_npz(args.out, qmodel)
+    print('float32: {:.1f} MB, int8: {:.1f} MB -> {}'.format(
+        quantized.model_bytes(model) / 2.0 ** 20,
+        quantized.model_bytes(qmodel) / 2.0 ** 20, args.out))
+    print('the int8 model only saves memory: it does not run faster than '
+          'the float32 one')
+
+    if args.val:
+        dataset = datasets.openDataset(args.val, args.root)
+        mean = np.load(args.mean).astype(np.float32)
+        probs, labels = evaluate(model, dataset, mean, args.batchsize)
+        qprobs, _ = evaluate(qmodel, dataset, mean, args.batchsize)
+        pred, qpred = probs.argmax(axis=1), qprobs.argmax(axis=1)
+        print('float32 accuracy: {:.4f}'.format((pred == labels).mean()))
+        print('int8 accuracy:    {:.4f}'.format((qpred == labels).mean()))
+        print('agreement: {:.4f}, max |p - p_int8|: {:.4f}'.format(
+            (pred == qpred).mean(), np.abs(probs - qprobs).max()))
+
+
+if __name__ == '__main__':
+    main()
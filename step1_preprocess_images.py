@@ -1,47 +1,51 @@
 import gdal, ogr, osr
 import shapefile
 import sys
-import utm
 import numpy as np
 import os
 import png
 from utils import visualizers as vs
+from utils import geotiff
 from utils import ray_algorithm as ray
+from utils import rasterize
+from utils import projection
+from utils import mask_io
+from utils import polygon_index
+from utils import profiling
+from utils import stage_cache
+from utils import mask_update
 
 # Global variables
 raster_data_path = "/Users/valentina/Documents/project/14SEP10130721-S2AS_R1C1-054168728010_01_P001.TIF"
 shp_data_path = '/Users/valentina/Documents/project/parkopedia-villa-maria-sao-paolo/parkopedia-villa-maria-sao-paolo.shp'
 cookie_size = 256
-
+cache_folder = stage_cache.default_folder ## artifact cache of the step outputs (None = always recompute)
+cache_size_mb = 20000 ## size limit of the artifact cache, least recently used entries are evicted
+incremental = True ## only redraw the lots changed since the last run (see utils/mask_update.py)
+mask_path = 'parking_matrix.pmask'
+index_path = 'parking_polygons.npz'
+manifest_path = 'parking_manifest.json' ## geometry hash and box of every shapefile record
+changes_path = 'parking_changes.json' ## boxes redrawn since step2 last read the mask
+
+@profiling.profiled()
 def loadGeotiff():
   """
-  It loads the geotiff image and converts it to a numpy RGB array. It also extracts the 
-  geo-transformation to convert lat-lon to pixel coordinates 
+  It opens the geotiff image as a windowed RGB reader: pixels are read block by block
+  when a window is sliced, so the whole scene is never loaded in memory. It also
+  extracts the geo-transformation to convert lat-lon to pixel coordinates
   """
-  ## Open and read geotiff
-  raster_geotiff = gdal.Open(raster_data_path, gdal.GA_ReadOnly)
-  geo_transform = raster_geotiff.GetGeoTransform()
-
-  r = []
-  b = []
-  g = []
-  band_r = raster_geotiff.GetRasterBand(3)
-  r.append(band_r.ReadAsArray())
-  band_g = raster_geotiff.GetRasterBand(2)
-  g.append(band_g.ReadAsArray())
-  band_b = raster_geotiff.GetRasterBand(1)
-  b.append(band_b.ReadAsArray())
-
-  image_array_RGB = np.dstack([r[:][0],g[:][0],b[:][0]])
+  ## Open geotiff (bands 3,2,1 = RGB)
+  image_array_RGB = geotiff.GeotiffReader(raster_data_path)
+  geo_transform = image_array_RGB.geo_transform
 
   return image_array_RGB, geo_transform
 
 def world2Pixel(geo_transform, x, y):
   """
   Uses a gdal geo_transform (gdal.GetGeoTransform()) to calculate
-  the pixel location of a geospatial coordinate 
+  the pixel location of a geospatial coordinate, rotation terms included
 
-  The line is a negative index: upper left is at line=0, lowest line is at -16383
+  Upper left is at line=0, pixel=0
 
   Arguments 
     ---------
@@ -49,28 +53,27 @@ def world2Pixel(geo_transform, x, y):
     geo_transform : bool
         output of gdal GetGeoTransform() function
 
-    x : int
-        latitude in utm 
+    x : float or numpy array
+        easting in the geotiff coordinate system
 
-    y : int
-        longitude in utm
+    y : float or numpy array
+        northing in the geotiff coordinate system
 
   """
 
-  ulX = geo_transform[0]        #/* top left x */
-  ulY = geo_transform[3]        #/* top left y */
-  xDist = geo_transform[1]        #/* w-e pixel resolution */
-  yDist = geo_transform[5]        #/* n-s pixel resolution */ 
-  rtnX = geo_transform[2]       #/* rotation, 0 if image is "north up" */
-  rtnY = geo_transform[4]       #/* rotation, 0 if image is "north up" */
-  pixel = int((x - ulX) / xDist)
-  line = abs(int((ulY - y) / yDist))
+  pixel, line = projection.worldToPixel(geo_transform, x, y)
+
+  if np.ndim(pixel) == 0:
+    return (int(np.floor(pixel)), int(np.floor(line)))
 
-  return (pixel, line) 
+  return (np.floor(pixel).astype(int), np.floor(line).astype(int))
 
-def getPolygons(sf, geo_transform):
+@profiling.profiled(items=len)
+def getPolygons(sf, geo_transform, raster_projection=None):
   """
-  Returns the list of polygons contained in sf.
+  Returns the list of polygons contained in sf, each one as a (n_vertices x 2) int
+  array of (line, pixel) coordinates. All the vertices of the shapefile are
+  projected at once.
   Arguments 
     ---------
 
@@ -81,28 +84,24 @@ def getPolygons(sf, geo_transform):
     geo_transform : bool
         output of gdal GetGeoTransform() function
 
-  """
-
-  poly_bounds = []
+    raster_projection : string
+        WKT of the geotiff coordinate system; UTM if not given
 
-  for polygon in sf.shapeRecords():
-
-    pixel_coords = []
-    line_coords = []
-
-    edge_list = []
-
-    for long_point, lat_point in polygon.shape.points:
+  """
 
-      # convert lat-long to UTM in accordance to the geotiff coord system
-      utm_coords = utm.from_latlon(lat_point, long_point)
+  shapes = sf.shapes()
+  if len(shapes) == 0:
+    return []
 
-      # convert utm to pixel line coords
-      xPixel, xLine = world2Pixel(geo_transform, utm_coords[0], utm_coords[1])
+  ## all the (long, lat) vertices of the shapefile in one array
+  num_points = [len(shape.points) for shape in shapes]
+  long_lat = np.concatenate([np.asarray(shape.points, dtype=np.float64).reshape(-1, 2) for shape in shapes])
 
-      edge_list.append(ray.Point(xLine, xPixel))
+  # convert lat-long to pixel line coords in accordance to the geotiff coord system
+  xPixel, xLine = projection.lonLatToPixel(long_lat[:, 0], long_lat[:, 1], geo_transform, raster_projection)
 
-    poly_bounds.append(ray.Polygon(edge_list))
+  line_pixel = np.column_stack([xLine, xPixel])
+  poly_bounds = np.split(line_pixel, np.cumsum(num_points)[:-1])
 
   return poly_bounds
 
@@ -117,26 +116,33 @@ def labelParkingPixels(image_size, polygons):
 
 
     polygons : list
-       	the list of polygons' edges
+       	the list of polygons, as ray.Polygon or (n_vertices x 2) line-pixel arrays
 
   """
 
-  parking_binary = np.zeros((image_size[0], image_size[1]), dtype=np.int)
+  parking_binary = np.zeros((image_size[0], image_size[1]), dtype=np.uint8)
 
-  for poly in polygons:
+  with profiling.stage('labelParkingPixels', items=len(polygons)):
 
-    [max_x, max_y, min_x, min_y] = poly.getBoundaries()
-    num_pixels = 0
-    for x in range(min_x, max_x):
-      for y in range(min_y, max_y):
-        if poly.contains(ray.Point(x, y)):
-          num_pixels += 1
-          parking_binary[x,y] = 1
+    for poly in polygons:
+      ## scanline fill: same even-odd rule as ray.Polygon.contains, one pass per polygon
+      rasterize.fillPolygon(parking_binary, poly)
 
   return parking_binary
 
 def main():
 
+  ## restore the outputs from the cache if the geotiff, the shapefile and the code of this step did not change
+  outputs = [mask_path, index_path, manifest_path]
+  cache = None
+  if cache_folder:
+    cache = stage_cache.StageCache(cache_folder, cache_size_mb * 2**20)
+    key = cache.fingerprint('step1', [raster_data_path] + stage_cache.shapefileParts(shp_data_path) + stage_cache.sourceFiles(__file__, globals().values()), {})
+    if cache.fetch(key, outputs):
+      mask_update.addChanges(changes_path)
+      print "Parking mask restored from the cache"
+      return
+
   ## read geotiff satellite image
   [image_array_RGB, geo_transform] = loadGeotiff()
 
@@ -144,13 +150,43 @@ def main():
   sf = shapefile.Reader(shp_data_path)
 
   ## get the polygons polygons
-  polygons = getPolygons(sf, geo_transform)
+  polygons = getPolygons(sf, geo_transform, image_array_RGB.projection)
+
+  ## geometry hash of every record, and spatial index of the polygons to query the lots near a window
+  hashes = [mask_update.recordHash(shape) for shape in sf.shapes()]
+  with profiling.stage('PolygonIndex', items=len(polygons)):
+    lots_index = polygon_index.PolygonIndex(polygons)
+
+  raster_key = mask_update.rasterKey(image_array_RGB)
+  manifest = mask_update.loadManifest(manifest_path)
+
+  if incremental and manifest is not None and manifest['raster'] == raster_key and os.path.exists(mask_path):
+
+    ## only redraw the boxes of the records added, removed or modified since the last run
+    added, removed = mask_update.changedRecords(manifest['hashes'], hashes)
+    boxes = np.concatenate([np.array(manifest['boxes'], dtype=np.int64).reshape(-1, 4)[removed], lots_index.boxes[added]])
+    with profiling.stage('updateMask', items=len(boxes)):
+      parking_matrix = mask_io.ParkingMask(mask_path, 'r+')
+      mask_update.updateMask(parking_matrix, lots_index, boxes)
+      parking_matrix.flush()
+    mask_update.addChanges(changes_path, boxes)
+    print "%d records added, %d removed: %d boxes redrawn" % (len(added), len(removed), len(boxes))
+
+  else:
+
+    ## get matrix of pixel labels (1 = is inside a parking polygon, 0 = otherwise)
+    parking_matrix = labelParkingPixels(image_array_RGB.shape, polygons)
+
+    ## save parking_matrix as a bit-packed tiled mask (opened memory-mapped by step2)
+    with profiling.stage('saveMask'):
+      mask_io.saveMask(mask_path, parking_matrix)
+    mask_update.addChanges(changes_path)
 
-  ## get matrix of pixel labels (1 = is inside a parking polygon, 0 = otherwise)
-  parking_matrix = labelParkingPixels(image_array_RGB.shape, polygons)
+  lots_index.save(index_path)
+  mask_update.saveManifest(manifest_path, raster_key, hashes, lots_index.boxes)
 
-  ## save parking_matrix as np array
-  np.save('parking_matrix.npy', parking_matrix)
+  if cache is not None:
+    cache.store(key, outputs)
 
 
 if __name__=="__main__":
@@ -4,93 +4,78 @@ import numpy as np
 import random
 import os
 from utils import visualizers as vs
-import png
+from utils import geotiff
+from utils import window_counts
+from utils import mask_io
+from utils import cookie_writer
+from utils import cookie_shards
+from utils import cookie_stream
+from utils import virtual_cookies
+from utils import polygon_index
+from utils import profiling
+from utils import stage_cache
+from utils import mask_update
+import json
 import shutil
 
 # Global variables
 raster_data_path = "/Users/valentina/Documents/project/14SEP10130721-S2AS_R1C1-054168728010_01_P001.TIF"
-parking_data_path = '/Users/valentina/Documents/project/parkopedia-git/parking_matrix.npy'
+parking_data_path = '/Users/valentina/Documents/project/parkopedia-git/parking_matrix.pmask'
+polygon_index_path = '/Users/valentina/Documents/project/parkopedia-git/parking_polygons.npz'
+parking_changes_path = '/Users/valentina/Documents/project/parkopedia-git/parking_changes.json' ## boxes of the mask redrawn by step1
 cookie_size = 256
 cookie_overlap = cookie_size / 4 ## number of overlapping pixels for segmentations 
 threshold_pixels = 100 ## minimum percentage of pixels required to be labeled as parking
 output_folder = 'cookies'
 random_seed = 12347 ## To aid reproducibility
-
+writer_processes = None ## processes encoding the PNG cookies (None = number of CPUs)
+queued_cookies = 32 ## cookies read ahead of the writer: bounds the memory of the cookies in flight
+output_format = 'png' ## 'png': one file per cookie, 'shards': fixed-record shard files, 'records': cookie coordinates only
+negative_ratio = 1 ## negative cookies kept per positive cookie with output_format = 'records'
+cache_folder = stage_cache.default_folder ## artifact cache of the step outputs (None = always recompute)
+cache_size_mb = 20000 ## size limit of the artifact cache, least recently used entries are evicted
+incremental_labels = True ## when step1 only redrew some lots and no cookie label changes, only update the coverage of the saved cookies
+
+@profiling.profiled()
 def loadGeotiff():
   """
-  It loads the geotiff image and converts it to a numpy RGB array. It also extracts the 
-  geo-transformation to convert lat-lon to pixel coordinates 
+  It opens the geotiff image as a windowed RGB reader: cookies are sliced from it
+  like a numpy array, and only the blocks they touch are read from disk
   """
-  ## Open and read geotiff
-  raster_geotiff = gdal.Open(raster_data_path, gdal.GA_ReadOnly)
-
-  r = []
-  b = []
-  g = []
-  band_r = raster_geotiff.GetRasterBand(3)
-  r.append(band_r.ReadAsArray())
-  band_g = raster_geotiff.GetRasterBand(2)
-  g.append(band_g.ReadAsArray())
-  band_b = raster_geotiff.GetRasterBand(1)
-  b.append(band_b.ReadAsArray())
-
-  image_array_RGB = np.dstack([r[:][0],g[:][0],b[:][0]])
+  ## Open geotiff (bands 3,2,1 = RGB)
+  image_array_RGB = geotiff.GeotiffReader(raster_data_path)
 
   return image_array_RGB
 
-def getCookie(image_array_RGB, line_start, pixel_start):
+def assignLabelsToCookies(parking_matrix, line_starts, pixel_starts):
   """
-  Segment the image: given the coord line-pixel, it 
-  extracts the corresponding cookie with (cookie_size x cookie_size)
-  
+  Label every cookie of the grid line_starts x pixel_starts in one call: a cookie
+  is labeled as parking (1) if at least threshold_pixels of its pixels are inside
+  a polygon. Returns the labels and the fraction of parking pixels of each cookie,
+  both with shape (len(line_starts), len(pixel_starts))
   Arguments 
     ---------
 
-    image_array_RGB : numpy array
-        RGB image extracted from the geotiff
+    parking_matrix : numpy array
+        binary matrix with 1 if the pixel is inside a parking polygon
 
-    line_start : int
-        row index of the image corresponding to the cookie first row  
+    line_starts : list
+        row indexes of the image corresponding to the cookies first row
 
-    pixel_start : int
-        column index of the image corresponding to the cookie first column
+    pixel_starts : list
+        column indexes of the image corresponding to the cookies first column
 
   """
-  return image_array_RGB[line_start:(line_start + cookie_size), pixel_start:(pixel_start+cookie_size)].copy() # Defensive copy
+  count_pixels = window_counts.gridCounts(parking_matrix, line_starts, pixel_starts, cookie_size)
 
-def assignLabelToCookie(parking_matrix, line_start, pixel_start):
-  """
-  Check if the coords (pixel_start, line_start) are inside the polygon that 
-  indicate the parking lot
-  Arguments 
-    ---------
-
-    poly_bounds : list
-        It contains the boundaries of all the polygons
+  labels = (count_pixels >= threshold_pixels).astype(int)
+  coverage = count_pixels / float(cookie_size * cookie_size)
 
-    line_start : int
-        row index of the image corresponding to the cookie first row  
-
-    pixel_start : int
-        column index of the image corresponding to the cookie first column
-
-  """
-  count_pixels = 0
-  
-  for line in range(line_start, line_start+cookie_size-1):
-    for pixel in range(pixel_start, pixel_start+cookie_size-1):
-        if not parking_matrix[line, pixel] == 0:
-        
-          count_pixels += 1
-          
-          if count_pixels == threshold_pixels:
-            return 1
-            
-  return 0
+  return labels, coverage
 
 def saveCookieAsPNG(cookie_name, cookie_npy):
   """
-  Save cookie_npy as a color PNG.
+  Save cookie_npy as a color PNG, scaled so that its maximum is 255.
   Arguments 
     ---------
 
@@ -102,27 +87,23 @@ def saveCookieAsPNG(cookie_name, cookie_npy):
 
   """
 
-  cookie_npy *= (255.0/cookie_npy.max())
-
-  with open(cookie_name, 'wb') as f:
-
-      writer = png.Writer(width=cookie_npy.shape[1], height=cookie_npy.shape[0])
-
-      # Convert cookie_npy to a list of lists expected by the png writer.
-      cookie_list = cookie_npy.reshape(-1, cookie_npy.shape[1]*cookie_npy.shape[2]).tolist()
-      writer.write(f, cookie_list)
+  cookie_writer.writePNG(cookie_name, cookie_writer.scaleCookie(cookie_npy))
 
+@profiling.profiled(items=lambda cookies: len(cookies[0]))
 def extractCookies(image_array_RGB, parking_matrix):
   """
-  It extract all the cookies from the geotiff and put it into a list
+  It lists all the cookies of the geotiff with their label, from the parking matrix
+  alone: the pixels of a cookie are only read when it is saved (see saveImages), so
+  the memory used does not grow with the number of cookies. Returns lists indexed by
+  cookie index of the (line, pixel) coordinates, labels, names and coverage
   Arguments 
     ---------
 
     image_array_RGB : numpy array
-        RGB image extracted from the geotiff
+        RGB image extracted from the geotiff (only its shape is used)
 
-    poly_bounds : list
-        It contains the boundaries of all the polygons
+    parking_matrix : numpy array
+        binary matrix with 1 if the pixel is inside a parking polygon
 
   """
 
@@ -131,20 +112,25 @@ def extractCookies(image_array_RGB, parking_matrix):
   #offset to remove the first and last 200 rows and lines of the image that are black
   offset_image = 200
 
-  idx_to_img = []
+  idx_to_coord = []
   idx_to_label = []
   idx_to_name = []
+  idx_to_coverage = []
+
+  line_starts = range(offset_image, image_array_RGB.shape[0] - cookie_size, cookie_overlap)
+  pixel_starts = range(offset_image, image_array_RGB.shape[1] - cookie_size, cookie_overlap)
 
-  for line_start_coord in range(offset_image, image_array_RGB.shape[0] - cookie_size, cookie_overlap):
+  ## label all the cookies at once, counting the parking pixels one strip of grid rows at a time
+  labels, coverage = assignLabelsToCookies(parking_matrix, line_starts, pixel_starts)
 
-    cookie = []
-    cookie_label = []
+  for i, line_start_coord in enumerate(line_starts):
 
-    for pixel_start_coord in range(offset_image, image_array_RGB.shape[1] - cookie_size, cookie_overlap):
+    for j, pixel_start_coord in enumerate(pixel_starts):
 
-      idx_to_img.append(getCookie(image_array_RGB, line_start_coord, pixel_start_coord))
-      cookie_label = assignLabelToCookie(parking_matrix, line_start_coord, pixel_start_coord)
+      idx_to_coord.append((line_start_coord, pixel_start_coord))
+      cookie_label = int(labels[i, j])
       idx_to_label.append(cookie_label)
+      idx_to_coverage.append(float(coverage[i, j]))
       idx_to_name.append('_'.join(['label', str(cookie_label), 'cookie', str(line_start_coord), str(pixel_start_coord), '.png']))
 
       if len(idx_to_name) % 1000 ==0:
@@ -152,11 +138,33 @@ def extractCookies(image_array_RGB, parking_matrix):
 
   print "...done"
 
-  return idx_to_img, idx_to_label, idx_to_name
+  return idx_to_coord, idx_to_label, idx_to_name, idx_to_coverage
 
-def saveImages(negative_cookies, positive_cookies, idx_to_name, idx_to_label, idx_to_img):
+def streamCookies(image_array_RGB, idx_to_coord, cookies):
   """
-  Saves each cookie as an RGB image and a csv file with the list of image urls and labels
+  Yields (cookie index, cookie image) for the given cookies, read in raster order
+  by a thread at most queued_cookies ahead of the caller (see utils/cookie_stream.py)
+  Arguments 
+    ---------
+
+    image_array_RGB : numpy array
+        RGB image extracted from the geotiff
+
+    idx_to_coord : list indexed by cookie index and the value is the (line, pixel) of the cookie
+
+    cookies : list of the indexes of the cookies to read
+
+  """
+  coords = [idx_to_coord[cookie_idx] for cookie_idx in cookies]
+  for i, cookie in cookie_stream.readWindows(image_array_RGB, coords, cookie_size, queued_cookies):
+    yield cookies[i], cookie
+
+@profiling.profiled(items=lambda count: count)
+def saveImages(negative_cookies, positive_cookies, idx_to_name, idx_to_label, image_array_RGB, idx_to_coord, callback=None):
+  """
+  Saves each cookie as an RGB image and a csv file with the list of image urls and labels.
+  The cookies are read from the geotiff by a thread while a pool of processes encodes
+  them, with a bounded number of cookies in between. Returns the number of cookies saved
   Arguments 
     ---------
 
@@ -168,7 +176,12 @@ def saveImages(negative_cookies, positive_cookies, idx_to_name, idx_to_label, id
 
     idx_to_label : list indexed by cookie index and the value is the cookie label
 
-    idx_to_img : list indexed by cookie index and the value is the cookie image
+    image_array_RGB : numpy array
+        RGB image extracted from the geotiff
+
+    idx_to_coord : list indexed by cookie index and the value is the (line, pixel) of the cookie
+
+    callback : function called with every saved cookie, as the uint8 RGB image written
 
   """
   output_path = output_folder + '_' + str(cookie_size)
@@ -181,31 +194,162 @@ def saveImages(negative_cookies, positive_cookies, idx_to_name, idx_to_label, id
   training_labels = []
   folder_dir = current_path + '/' + output_path + '/' 
   
+  selected_cookies = []
   for idx in range(0, len(positive_cookies)):
 
     training_labels.append(folder_dir + idx_to_name[negative_cookies[idx]] + ' ' + str(idx_to_label[negative_cookies[idx]]) + '\n')
     training_labels.append(folder_dir + idx_to_name[positive_cookies[idx]] + ' ' + str(idx_to_label[positive_cookies[idx]]) + '\n')
+    selected_cookies.extend([negative_cookies[idx], positive_cookies[idx]])
+
+  ## encode the PNGs in a pool of processes, with a bounded number of pending cookies
+  with cookie_writer.CookieWriter(processes=writer_processes) as writer:
+
+    for cookie_idx, cookie_npy in streamCookies(image_array_RGB, idx_to_coord, selected_cookies):
 
-    saveCookieAsPNG(folder_dir + idx_to_name[negative_cookies[idx]], idx_to_img[negative_cookies[idx]])
-    saveCookieAsPNG(folder_dir + idx_to_name[positive_cookies[idx]], idx_to_img[positive_cookies[idx]])
+      cookie = writer.write(folder_dir + idx_to_name[cookie_idx], cookie_npy)
+      if callback is not None:
+        callback(cookie)
 
   with open('./' + output_path  + '/training_labels.csv','w') as fileCSV:
 
     fileCSV.writelines(training_labels)
 
-def main():
+  return len(training_labels)
 
-  ## Set the random seed to aid reproducibility
-  np.random.seed(random_seed)
+@profiling.profiled(items=lambda count: count)
+def saveShards(negative_cookies, positive_cookies, idx_to_name, idx_to_label, image_array_RGB, idx_to_coord, callback=None):
+  """
+  Saves the same cookies as saveImages, in the order they are read from the geotiff,
+  into a few large shard files of raw uint8 CHW records with an index of labels and
+  coordinates (see utils/cookie_shards.py). records.txt lists the records to split
+  into the training and validation sets in the order of training_labels.csv (negative
+  and positive cookies interleaved). Returns the number of cookies saved
+  Arguments 
+    ---------
+
+    negative_cookies : list of negative cookies
+
+    positive_cookies : list of positive cookies
+
+    idx_to_name : list indexed by cookie index and the value is the cookie name
+
+    idx_to_label : list indexed by cookie index and the value is the cookie label
+
+    image_array_RGB : numpy array
+        RGB image extracted from the geotiff
+
+    idx_to_coord : list indexed by cookie index and the value is the (line, pixel) of the cookie
+
+    callback : function called with every saved cookie, as the uint8 RGB image written
+
+  """
+  output_path = output_folder + '_' + str(cookie_size)
+
+  if os.path.exists(output_path):
+    shutil.rmtree(output_path, ignore_errors=True)
+
+  with cookie_shards.ShardWriter(output_path, cookie_size) as writer:
+
+    selected_cookies = []
+    for idx in range(0, len(positive_cookies)):
+      selected_cookies.extend([negative_cookies[idx], positive_cookies[idx]])
+
+    ## the cookies are written in raster order, records.txt follows the selection order
+    rank = dict((cookie_idx, k) for k, cookie_idx in enumerate(selected_cookies))
+    for cookie_idx, cookie_npy in streamCookies(image_array_RGB, idx_to_coord, selected_cookies):
+
+      line_start_coord, pixel_start_coord = idx_to_coord[cookie_idx]
+      cookie = cookie_writer.scaleCookie(cookie_npy)
+      writer.write(cookie, idx_to_label[cookie_idx], line_start_coord, pixel_start_coord, rank[cookie_idx])
+      if callback is not None:
+        callback(cookie)
+
+  return 2 * len(positive_cookies)
+
+@profiling.profiled()
+def saveRecords(image_shape, parking_matrix):
+  """
+  Saves the (line, pixel, label) records of a balanced subset of the cookies
+  instead of the cookies themselves: the training datasets crop them on demand
+  from the geotiff (see utils/virtual_cookies.py). No cookie is extracted, so
+  changing cookie_size, cookie_overlap or negative_ratio only rewrites the records
+  Arguments 
+    ---------
+
+    image_shape : tuple
+        shape of the geotiff image
+
+    parking_matrix : numpy array
+        binary matrix with 1 if the pixel is inside a parking polygon
+
+  """
+  output_path = output_folder + '_' + str(cookie_size)
+
+  if os.path.exists(output_path):
+    shutil.rmtree(output_path, ignore_errors=True)
+
+  #offset to remove the first and last 200 rows and lines of the image that are black
+  offset_image = 200
+
+  records = virtual_cookies.gridRecords(image_shape, parking_matrix, cookie_size, cookie_overlap, threshold_pixels, offset_image)
+  records = virtual_cookies.balanceRecords(records, negative_ratio, random_seed)
+
+  virtual_cookies.saveVirtual(output_path, raster_data_path, cookie_size, records)
+
+@profiling.profiled(items=lambda count: count)
+def saveCoverage(idx_to_name, idx_to_coverage, lots_index=None):
+  """
+  Saves a csv file with the fraction of parking pixels of every extracted cookie
+  and, if the spatial index of the polygons is given, the indices of the lots
+  whose bounding box intersects the cookie (- if none). Returns the number of rows
+  Arguments 
+    ---------
+
+    idx_to_name : list indexed by cookie index and the value is the cookie name
+
+    idx_to_coverage : list indexed by cookie index and the value is the fraction
+        of the cookie pixels inside a parking polygon
+
+    lots_index : PolygonIndex
+        spatial index of the parking polygons (see utils/polygon_index.py)
+
+  """
+  output_path = output_folder + '_' + str(cookie_size)
+
+  lines = []
+  for name, cov in zip(idx_to_name, idx_to_coverage):
+    line = name + ' ' + repr(cov)
+    if lots_index is not None:
+      ## cookie names are label_<label>_cookie_<line>_<pixel>_.png
+      line_start_coord, pixel_start_coord = [int(c) for c in name.split('_')[3:5]]
+      lots = lots_index.query(line_start_coord, pixel_start_coord, cookie_size)
+      line += ' ' + (','.join(str(lot) for lot in lots) or '-')
+    lines.append(line + '\n')
+
+  with open('./' + output_path + '/cookie_coverage.csv', 'w') as fileCSV:
+
+    fileCSV.writelines(lines)
+
+  return len(lines)
+
+def saveCookies():
+  """
+  Extracts the cookies of the geotiff and saves them in the format given by output_format
+  """
 
   ## read geotiff satellite image
   image_array_RGB = loadGeotiff()
 
-  ## read the numpy array with polygons
-  parking_matrix = np.load(parking_data_path)
+  ## open the parking mask memory-mapped: only the tiles that are read get paged in
+  parking_matrix = mask_io.openMask(parking_data_path)
+
+  ## virtual cookies: only save the records of the cookies
+  if output_format == 'records':
+    saveRecords(image_array_RGB.shape, parking_matrix)
+    return
 
   ## segment image to extract train and test cookies
-  [idx_to_img, idx_to_label, idx_to_name] = extractCookies(image_array_RGB, parking_matrix)
+  [idx_to_coord, idx_to_label, idx_to_name, idx_to_coverage] = extractCookies(image_array_RGB, parking_matrix)
 
   ## get list of cookies in parking lots
   positive_cookies = [i for i, j in enumerate(idx_to_label) if j == 1]
@@ -215,7 +359,120 @@ def main():
   random.shuffle(negative_cookies)
 
   ## save cookies: save positive and negative cookies
-  saveImages(negative_cookies, positive_cookies, idx_to_name, idx_to_label, idx_to_img)
+  if output_format == 'shards':
+    saveShards(negative_cookies, positive_cookies, idx_to_name, idx_to_label, image_array_RGB, idx_to_coord)
+  else:
+    saveImages(negative_cookies, positive_cookies, idx_to_name, idx_to_label, image_array_RGB, idx_to_coord)
+
+  ## save the exact parking coverage of every cookie, and the lots it intersects
+  lots_index = None
+  if os.path.exists(polygon_index_path):
+    lots_index = polygon_index.loadPolygonIndex(polygon_index_path)
+  saveCoverage(idx_to_name, idx_to_coverage, lots_index)
+
+def relabelCookies(boxes):
+  """
+  Updates the coverage of the cookies that overlap the boxes of the parking mask redrawn
+  by step1, instead of extracting the cookies again. The balanced selection of the saved
+  cookies depends on the label of every cookie, so as soon as the label of one of them
+  changes (and for the records, which do not keep the labels of the cookies left out)
+  the cookies are saved again by saveCookies: the result is always the one of a full run.
+  Returns the number of cookies whose window was recomputed, or None if they were saved again
+  Arguments 
+    ---------
+
+    boxes : list
+        (line0, pixel0, line1, pixel1) boxes of the mask that changed
+
+  """
+  output_path = output_folder + '_' + str(cookie_size)
+  coverage_path = os.path.join(output_path, 'cookie_coverage.csv')
+  if output_format == 'records' or not os.path.exists(coverage_path):
+    saveCookies()
+    return None
+
+  parking_matrix = mask_io.openMask(parking_data_path)
+  boxes = np.array(boxes, dtype=np.int64).reshape(-1, 4)
+  lots_index = None
+  if os.path.exists(polygon_index_path):
+    lots_index = polygon_index.loadPolygonIndex(polygon_index_path)
+
+  ## the coverage csv lists every cookie of the grid, named label_<label>_cookie_<line>_<pixel>_.png
+  with open(coverage_path) as fileCSV:
+    rows = [line.split() for line in fileCSV if line.strip()]
+  coords = np.array([[int(c) for c in row[0].split('_')[3:5]] for row in rows], dtype=np.int64).reshape(-1, 2)
+  touched = ((coords[:, 0, None] < boxes[None, :, 2]) & (coords[:, 0, None] + cookie_size > boxes[None, :, 0]) &
+             (coords[:, 1, None] < boxes[None, :, 3]) & (coords[:, 1, None] + cookie_size > boxes[None, :, 1])).any(axis=1)
+
+  for r in np.nonzero(touched)[0]:
+    line_start_coord, pixel_start_coord = coords[r]
+    window = parking_matrix[line_start_coord:line_start_coord + cookie_size, pixel_start_coord:pixel_start_coord + cookie_size]
+    count_pixels = int(np.count_nonzero(window))
+    if int(count_pixels >= threshold_pixels) != int(rows[r][0].split('_')[1]):
+      ## a label changed: the selection of the cookies (and their names) changes too
+      saveCookies()
+      return None
+    rows[r][1] = repr(count_pixels / float(cookie_size * cookie_size))
+    if lots_index is not None:
+      lots = lots_index.query(line_start_coord, pixel_start_coord, cookie_size)
+      rows[r][2:] = [','.join(str(lot) for lot in lots) or '-']
+
+  with open(coverage_path, 'w') as fileCSV:
+    fileCSV.writelines(' '.join(row) + '\n' for row in rows)
+
+  return int(touched.sum())
+
+def main():
+
+  ## Set the random seeds to aid reproducibility (the negative cookies are shuffled with random)
+  np.random.seed(random_seed)
+  random.seed(random_seed)
+
+  output_path = output_folder + '_' + str(cookie_size)
+  params = {'raster_data_path': os.path.abspath(raster_data_path), 'parking_data_path': os.path.abspath(parking_data_path),
+            'cookie_size': cookie_size, 'cookie_overlap': cookie_overlap, 'threshold_pixels': threshold_pixels,
+            'random_seed': random_seed, 'output_format': output_format, 'negative_ratio': negative_ratio,
+            'output_folder': output_folder, 'cwd': os.getcwd()}
+  params_path = os.path.join(output_path, 'parameters.json')
+
+  ## restore the cookies from the cache if the inputs and the parameters did not change
+  ## (the current folder is a parameter: the training list holds absolute paths)
+  cache = None
+  restored = False
+  if cache_folder:
+    cache = stage_cache.StageCache(cache_folder, cache_size_mb * 2**20)
+    inputs = [raster_data_path, parking_data_path, polygon_index_path] + stage_cache.sourceFiles(__file__, globals().values())
+    key = cache.fingerprint('step2', inputs, params)
+    restored = cache.fetch(key, [output_path])
+
+  changes = mask_update.loadChanges(parking_changes_path)
+  saved_params = None
+  if os.path.exists(params_path):
+    with open(params_path) as f:
+      saved_params = json.load(f)
+
+  if restored:
+    print "Cookies restored from the cache"
+
+  elif incremental_labels and changes is not None and not changes['full'] and saved_params == params:
+    ## step1 only redrew a few lots: update the cookies saved with the same parameters
+    updated = relabelCookies(changes['boxes'])
+    if updated is None:
+      print "Cookie labels changed: cookies saved again"
+    else:
+      print "%d cookies updated, no label changed" % updated
+
+  else:
+    saveCookies()
+    with open(params_path, 'w') as f:
+      json.dump(params, f)
+
+  if cache is not None and not restored:
+    cache.store(key, [output_path])
+
+  ## the cookies are up to date with the mask
+  if changes is not None:
+    os.remove(parking_changes_path)
 
 if __name__=="__main__":
   main()
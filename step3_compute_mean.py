@@ -1,37 +1,177 @@
 #!/usr/bin/env python
 import argparse
+import multiprocessing
 import sys
 
 import numpy as np
 
-import chainer
+from utils import profiling
+from utils import stage_cache
 
 
-def compute_mean(dataset):
-    print('compute mean image')
-    sum_image = 0
+class Moments(object):
+
+    """Count, per-pixel mean and per-channel mean/M2 of a set of images.
+
+    Partial moments of disjoint chunks are merged with the parallel
+    variant of Welford's method (Chan et al.), so chunks can be reduced in
+    any order without a second pass over the images.
+    """
+
+    def __init__(self, images=None):
+        self.count = 0
+        self.mean = 0.
+        self.channel_count = 0
+        self.channel_mean = 0.
+        self.channel_m2 = 0.
+        if images is not None and len(images):
+            images = np.asarray(images, dtype=np.float64)
+            self.count = len(images)
+            self.mean = images.mean(axis=0)
+            pixels = images.transpose(1, 0, 2, 3).reshape(images.shape[1], -1)
+            self.channel_count = pixels.shape[1]
+            self.channel_mean = pixels.mean(axis=1)
+            self.channel_m2 = ((pixels - self.channel_mean[:, None]) ** 2).sum(axis=1)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.__dict__.update(other.__dict__)
+            return self
+        count = self.count + other.count
+        self.mean = self.mean + (other.mean - self.mean) * (float(other.count) / count)
+        self.count = count
+
+        channel_count = self.channel_count + other.channel_count
+        delta = other.channel_mean - self.channel_mean
+        self.channel_mean = self.channel_mean + delta * (float(other.channel_count) / channel_count)
+        self.channel_m2 = (self.channel_m2 + other.channel_m2 +
+                           delta ** 2 * (float(self.channel_count) * other.channel_count / channel_count))
+        self.channel_count = channel_count
+        return self
+
+    @property
+    def channel_std(self):
+        return np.sqrt(self.channel_m2 / self.channel_count)
+
+
+_dataset = None
+
+
+def _init_worker(dataset):
+    global _dataset
+    _dataset = dataset
+
+
+def _chunk_moments(indexes):
+    return Moments([_dataset[i][0] for i in indexes])
+
+
+@profiling.profiled(items=lambda moments: moments.count)
+def compute_statistics(dataset, processes=1, chunk_size=32, sample=None,
+                       seed=None):
+    """Single pass over the dataset (or a random sample of ``sample`` images).
+
+    Chunks of ``chunk_size`` images are decoded and reduced in ``processes``
+    worker processes; their partial moments are merged as they arrive.
+    Returns a :class:`Moments`.
+    """
     N = len(dataset)
-    for i, (image, _) in enumerate(dataset):
-        sum_image += image
-        sys.stderr.write('{} / {}\r'.format(i, N))
-        sys.stderr.flush()
+    order = np.arange(N)
+    if sample is not None and sample < N:
+        order = np.random.RandomState(seed).permutation(N)[:sample]
+    chunks = [order[i:i + chunk_size] for i in range(0, len(order), chunk_size)]
+
+    total = Moments()
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, _init_worker, (dataset,))
+        partials = pool.imap_unordered(_chunk_moments, chunks)
+    else:
+        pool = None
+        _init_worker(dataset)
+        partials = (_chunk_moments(chunk) for chunk in chunks)
+    try:
+        for partial in partials:
+            total.merge(partial)
+            sys.stderr.write('{} / {}\r'.format(total.count, len(order)))
+            sys.stderr.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     sys.stderr.write('\n')
-    return sum_image / N
+    return total
+
+
+def compute_mean(dataset, processes=1, sample=None, seed=None):
+    print('compute mean image')
+    moments = compute_statistics(dataset, processes, sample=sample, seed=seed)
+    return moments.mean.astype(np.float32)
 
 
 def main():
     parser = argparse.ArgumentParser(description='Compute images mean array')
     parser.add_argument('dataset',
-                        help='Path to training image-label list file')
+                        help='Path to training image-label list file or cookie shards')
     parser.add_argument('--root', '-R', default='.',
                         help='Root directory path of image files')
     parser.add_argument('--output', '-o', default='mean.npy',
                         help='path to output mean array')
+    parser.add_argument('--stats', '-s', default='',
+                        help='path to output npz with the per-pixel mean, '
+                        'per-channel mean/std and image count')
+    parser.add_argument('--loaderjob', '-j', type=int, default=1,
+                        help='Number of parallel data loading processes')
+    parser.add_argument('--sample', type=int,
+                        help='Only use a random sample of this many images')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed of the sample')
+    parser.add_argument('--profile', default='',
+                        help='Write the time and memory of every stage to '
+                        'this file (Chrome trace if it ends with .json)')
+    parser.add_argument('--cache_dir', default=stage_cache.default_folder,
+                        help='Artifact cache of the outputs, reused while '
+                        'the images and arguments do not change (empty '
+                        'to disable)')
+    parser.add_argument('--cache_mb', type=int, default=20000,
+                        help='Size limit of the artifact cache')
     args = parser.parse_args()
+    # Imported here: it loads chainer, which the Moments users don't need
+    from utils import datasets
+    if args.profile:
+        profiling.enable(args.profile)
 
-    dataset = chainer.datasets.LabeledImageDataset(args.dataset, args.root)
-    mean = compute_mean(dataset)
-    np.save(args.output, mean)
+    # numpy adds the extension when it is missing
+    output = args.output if args.output.endswith('.npy') else args.output + '.npy'
+    stats = args.stats
+    if stats and not stats.endswith('.npz'):
+        stats += '.npz'
+    outputs = [output] + ([stats] if stats else [])
+    cache = None
+    if args.cache_dir:
+        cache = stage_cache.StageCache(args.cache_dir, args.cache_mb * 2 ** 20)
+        key = cache.fingerprint(
+            'step3', datasets.datasetFiles(args.dataset, args.root) +
+            stage_cache.sourceFiles(__file__, [datasets] + list(globals().values())),
+            {'sample': args.sample, 'seed': args.seed, 'stats': bool(stats)})
+        if cache.fetch(key, outputs):
+            print('mean image restored from the cache')
+            return
+
+    dataset = datasets.openDataset(args.dataset, args.root)
+    print('compute mean image')
+    moments = compute_statistics(dataset, args.loaderjob, sample=args.sample,
+                                 seed=args.seed)
+    np.save(output, moments.mean.astype(np.float32))
+    print('{} images, channel mean {}, channel std {}'.format(
+        moments.count, moments.channel_mean, moments.channel_std))
+    if stats:
+        np.savez(stats, mean=moments.mean.astype(np.float32),
+                 channel_mean=moments.channel_mean,
+                 channel_std=moments.channel_std, count=moments.count)
+    if cache is not None:
+        cache.store(key, outputs)
 
 
 if __name__ == '__main__':
@@ -10,22 +10,47 @@ from chainer.training import extensions
 
 import alex
 import googlenet
-import googlenetbn
-import nin
+import parallel_updater
+import parkingnet
 import pdb
+from utils import datasets
+from utils import shared_cache
 
 
 class PreprocessedDataset(chainer.dataset.DatasetMixin):
 
-    def __init__(self, path, root, mean, crop_size, random=True):
-        self.base = chainer.datasets.LabeledImageDataset(path, root)
+    def __init__(self, path, root, mean, crop_size, random=True,
+                 cache_bytes=0, raw=False):
+        # With raw=True, examples are the decoded uint8 images: cropping,
+        # flipping and scaling are left to BatchPreprocessConverter
+        self.base = datasets.openDataset(
+            path, root, np.uint8 if raw else np.float32)
         self.mean = mean.astype('f')
         self.crop_size = crop_size
         self.random = random
+        self.raw = raw
+        # Decoded images shared by all the loader processes (optional)
+        self.cache = None
+        if cache_bytes > 0 and len(self.base) > 0:
+            image, _ = self.base[0]
+            self.cache = shared_cache.SharedImageCache(
+                len(self.base), image.shape, cache_bytes, image.dtype)
 
     def __len__(self):
         return len(self.base)
 
+    def load(self, i):
+        # It returns the decoded i-th image/label pair, from the cache if any
+        if self.cache is None:
+            return self.base[i]
+        cached = self.cache.get(i)
+        if cached is not None:
+            image, label = cached
+            return image, np.int32(label)
+        image, label = self.base[i]
+        self.cache.put(i, image, label)
+        return image, label
+
     def get_example(self, i):
         # It reads the i-th image/label pair and return a preprocessed image.
         # It applies following preprocesses:
@@ -33,7 +58,9 @@ class PreprocessedDataset(chainer.dataset.DatasetMixin):
         #     - Random flip
         #     - Scaling to [0, 1] value
         crop_size = self.crop_size
-        image, label = self.base[i]
+        image, label = self.load(i)
+        if self.raw:
+            return image, label
         _, h, w = image.shape
 
         if self.random:
@@ -55,6 +82,74 @@ class PreprocessedDataset(chainer.dataset.DatasetMixin):
         return image, label
 
 
+class BatchPreprocessConverter(object):
+
+    """Batch version of the PreprocessedDataset preprocessing.
+
+    It takes the raw (uint8) examples of a ``PreprocessedDataset`` created
+    with ``raw=True``, draws the crop offsets and flip flags of the whole
+    batch at once and writes every cropped, flipped, mean-subtracted image
+    from views of the stacked batch into a preallocated float32 output,
+    scaled in place. The stack and the output are reused from batch to
+    batch, so the returned array is only valid until the next call.
+    """
+
+    def __init__(self, mean, crop_size, random=True, seed=None):
+        self.mean = mean.astype('f')
+        self.crop_size = crop_size
+        self.random = random
+        self.rng = np.random.RandomState(seed)
+        self._stack = None
+        self._out = None
+
+    def _buffers(self, batch_size, image):
+        shape = (batch_size,) + image.shape
+        if self._stack is None or self._stack.shape != shape or \
+                self._stack.dtype != image.dtype:
+            self._stack = np.empty(shape, dtype=image.dtype)
+            self._out = np.empty(
+                (batch_size, image.shape[0], self.crop_size, self.crop_size),
+                dtype=np.float32)
+        return self._stack, self._out
+
+    def __call__(self, batch, device=None):
+        stack, out = self._buffers(len(batch), batch[0][0])
+        for k, (image, _) in enumerate(batch):
+            stack[k] = image
+        labels = np.asarray([label for _, label in batch], dtype=np.int32)
+
+        n, c, h, w = stack.shape
+        crop_size = self.crop_size
+        if self.random:
+            # Same ranges as PreprocessedDataset (random.randint is inclusive)
+            top = self.rng.randint(0, h - crop_size, size=n)
+            left = self.rng.randint(0, w - crop_size, size=n)
+            flip = self.rng.randint(0, 2, size=n).astype(bool)
+        else:
+            top = np.full(n, (h - crop_size) // 2, dtype=np.int64)
+            left = np.full(n, (w - crop_size) // 2, dtype=np.int64)
+            flip = np.zeros(n, dtype=bool)
+
+        # Crop and flip are views of the stack and the mean, subtracted
+        # straight into the output: no batch-sized temporary. A flipped image
+        # is cropped from its mirrored columns; the mean is not flipped, as
+        # in PreprocessedDataset
+        for i in range(n):
+            rows = slice(top[i], top[i] + crop_size)
+            cols = slice(left[i], left[i] + crop_size)
+            if flip[i]:
+                crop = stack[i, :, rows, w - cols.stop:w - cols.start][:, :, ::-1]
+            else:
+                crop = stack[i, :, rows, cols]
+            np.subtract(crop, self.mean[:, rows, cols], out=out[i])
+        out *= (1.0 / 255.0)  # Scale to [0, 1]
+
+        if device is not None and device >= 0:
+            return (chainer.cuda.to_gpu(out, device),
+                    chainer.cuda.to_gpu(labels, device))
+        return out, labels
+
+
 class TestModeEvaluator(extensions.Evaluator):
 
     def evaluate(self):
@@ -69,13 +164,16 @@ def main():
     archs = {
         'alex': alex.Alex,
         'googlenet': googlenet.GoogLeNet,
+        'parking_tiny': parkingnet.ParkingNetTiny,
+        'parking_small': parkingnet.ParkingNetSmall,
+        'parking_medium': parkingnet.ParkingNetMedium,
     }
 
     parser = argparse.ArgumentParser(
         description='Learning convnet from ILSVRC2012 dataset')
-    parser.add_argument('train', help='Path to training image-label list file')
-    parser.add_argument('val', help='Path to validation image-label list file')
-    parser.add_argument('--arch', '-a', choices=archs.keys(), default='nin',
+    parser.add_argument('train', help='Path to training image-label list file or cookie shards')
+    parser.add_argument('val', help='Path to validation image-label list file or cookie shards')
+    parser.add_argument('--arch', '-a', choices=archs.keys(), default='alex',
                         help='Convnet architecture')
     parser.add_argument('--batchsize', '-B', type=int, default=32,
                         help='Learning minibatch size')
@@ -97,9 +195,21 @@ def main():
                         help='Root directory path of image files')
     parser.add_argument('--val_batchsize', '-b', type=int, default=250,
                         help='Validation minibatch size')
+    parser.add_argument('--cache_mb', type=int, default=0,
+                        help='Shared memory cache of decoded images per '
+                        'dataset, in MB (0 disables it)')
+    parser.add_argument('--batch_augment', action='store_true',
+                        help='Crop, flip and scale whole batches in the '
+                        'converter instead of image by image')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help='Number of processes training on shards of '
+                        'every batch (CPU only; set OMP_NUM_THREADS to the '
+                        'cores per process)')
     parser.add_argument('--test', action='store_true')
     parser.set_defaults(test=True)
     args = parser.parse_args()
+    if args.workers > 1 and args.gpu >= 0:
+        parser.error('--workers is for CPU training')
 
     # Initialize the model to train
     model = archs[args.arch]()
@@ -112,8 +222,18 @@ def main():
 
     # Load the datasets and mean file
     mean = np.load(args.mean)
-    train = PreprocessedDataset(args.train, args.root, mean, model.insize)
-    val = PreprocessedDataset(args.val, args.root, mean, model.insize, False)
+    cache_bytes = args.cache_mb * 2 ** 20
+    train = PreprocessedDataset(args.train, args.root, mean, model.insize,
+                                cache_bytes=cache_bytes,
+                                raw=args.batch_augment)
+    val = PreprocessedDataset(args.val, args.root, mean, model.insize, False,
+                              cache_bytes=cache_bytes,
+                              raw=args.batch_augment)
+    if args.batch_augment:
+        train_converter = BatchPreprocessConverter(mean, model.insize)
+        val_converter = BatchPreprocessConverter(mean, model.insize, False)
+    else:
+        train_converter = val_converter = chainer.dataset.concat_examples
 
     # These iterators load the images with subprocesses running in parallel to
     # the training/validation.
@@ -127,15 +247,26 @@ def main():
     optimizer.setup(model)
 
     # Set up a trainer
-    updater = training.StandardUpdater(train_iter, optimizer, device=args.gpu)
+    if args.workers > 1:
+        updater = parallel_updater.ParallelUpdater(
+            train_iter, optimizer, args.workers, converter=train_converter)
+    else:
+        updater = training.StandardUpdater(train_iter, optimizer,
+                                           converter=train_converter,
+                                           device=args.gpu)
     trainer = training.Trainer(updater, (args.epoch, 'epoch'), args.out)
 
     val_interval = (1 if args.test else 100000), 'iteration'
     log_interval = (1 if args.test else 1000), 'iteration'
 
-    trainer.extend(TestModeEvaluator(val_iter, model, device=args.gpu),
+    trainer.extend(TestModeEvaluator(val_iter, model,
+                                     converter=val_converter,
+                                     device=args.gpu),
                    trigger=val_interval)
-    trainer.extend(extensions.dump_graph('main/loss'))
+    if args.workers == 1:
+        # ParallelUpdater reports the loss of the batch as a float, which
+        # has no graph to dump
+        trainer.extend(extensions.dump_graph('main/loss'))
     trainer.extend(extensions.snapshot(), trigger=val_interval)
     trainer.extend(extensions.snapshot_object(
         model, 'model_iter_{.updater.iteration}'), trigger=val_interval)
@@ -143,10 +274,16 @@ def main():
     # (it determines when to emit log rather than when to read observations)
     trainer.extend(extensions.LogReport(trigger=log_interval))
     trainer.extend(extensions.observe_lr(), trigger=log_interval)
-    trainer.extend(extensions.PrintReport([
+    report = [
         'epoch', 'iteration', 'main/loss', 'validation/main/loss',
         'main/accuracy', 'validation/main/accuracy', 'lr'
-    ]), trigger=log_interval)
+    ]
+    if train.cache is not None:
+        trainer.extend(extensions.observe_value(
+            'cache_hit_rate', lambda _: train.cache.hit_rate),
+            trigger=log_interval)
+        report.append('cache_hit_rate')
+    trainer.extend(extensions.PrintReport(report), trigger=log_interval)
     trainer.extend(extensions.ProgressBar(update_interval=1))
 
     if args.resume:
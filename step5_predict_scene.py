@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import chainer
+import gdal
+
+import alex
+import googlenet
+import parkingnet
+import quantized
+from utils import geotiff
+
+
+nodata = -1.0
+
+
+def blendWeights(size, blend):
+    """Per-pixel weight of a window when overlapping predictions are blended.
+
+    'mean' averages the overlapping windows uniformly; 'hann' favours the
+    centre of each window, which hides the seams between windows.
+    """
+    if blend == 'mean':
+        return np.ones((size, size), dtype=np.float32)
+    w = np.hanning(size + 2)[1:-1].astype(np.float32)
+    return np.outer(w, w)
+
+
+def preprocessWindows(windows, mean, crop_size):
+    """(N, size, size, 3) raw geotiff windows to the network input.
+
+    Same as the validation path of training: each window is stretched to
+    [0, 255] like the PNG cookies, centre-cropped, mean-subtracted and
+    scaled to [0, 1].
+    """
+    n, size = windows.shape[:2]
+    maxes = windows.reshape(n, -1).max(axis=1).astype(np.float64)
+    scale = np.where(maxes > 0, 255.0 / np.maximum(maxes, 1), 0)
+    cookies = (windows * scale[:, None, None, None]).astype(np.uint8)
+
+    top = (size - crop_size) // 2
+    x = cookies[:, top:top + crop_size, top:top + crop_size, :]
+    x = x.transpose(0, 3, 1, 2).astype(np.float32)
+    x -= mean[:, top:top + crop_size, top:top + crop_size]
+    x *= (1.0 / 255.0)
+    return x
+
+
+class ProbabilityRaster(object):
+
+    """Georeferenced float32 probability raster written strip by strip.
+
+    Window predictions are accumulated (weighted) in a buffer of
+    ``buffer_lines`` lines (by default one window); lines that no later
+    window row can reach are normalised and written out, so memory does
+    not depend on the scene height. Lines no window covers are set to
+    ``nodata``.
+    """
+
+    def __init__(self, path, reader, window_size, weights, buffer_lines=None):
+        lines, pixels = reader.shape[:2]
+        driver = gdal.GetDriverByName('GTiff')
+        self.dataset = driver.Create(
+            path, pixels, lines, 1, gdal.GDT_Float32,
+            ['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+        self.dataset.SetGeoTransform(reader.geo_transform)
+        self.dataset.SetProjection(reader.projection)
+        self.band = self.dataset.GetRasterBand(1)
+        self.band.SetNoDataValue(nodata)
+
+        self.lines = lines
+        self.size = window_size
+        self.weights = weights
+        self.buffer_lines = buffer_lines or window_size
+        self.prob = np.zeros((self.buffer_lines, pixels), dtype=np.float32)
+        self.weight = np.zeros((self.buffer_lines, pixels), dtype=np.float32)
+        self.start = 0  # first line held by the buffer
+
+    def _flush(self, count):
+        count = min(count, self.lines - self.start)
+        if count <= 0:
+            return
+        weight = self.weight[:count]
+        out = np.full(weight.shape, nodata, dtype=np.float32)
+        np.divide(self.prob[:count], weight, out=out, where=weight > 0)
+        self.band.WriteArray(out, 0, self.start)
+        self.start += count
+
+    def moveTo(self, line):
+        """Writes out every line before ``line`` and makes it the first
+        line of the buffer."""
+        while self.start < line:
+            shift = min(line - self.start, self.buffer_lines)
+            self._flush(shift)
+            self.prob[:-shift] = self.prob[shift:]
+            self.prob[-shift:] = 0
+            self.weight[:-shift] = self.weight[shift:]
+            self.weight[-shift:] = 0
+
+    def add(self, line, pixel, probability):
+        rows = slice(line - self.start, line - self.start + self.size)
+        cols = slice(pixel, pixel + self.size)
+        self.prob[rows, cols] += probability * self.weights
+        self.weight[rows, cols] += self.weights
+
+    def close(self):
+        self.moveTo(self.lines)
+        self.band.FlushCache()
+        self.band = None
+        self.dataset = None
+
+
+def predictScene(reader, predict, mean, crop_size, output, window_size=256,
+                 stride=64, offset=200, batchsize=64, blend='hann'):
+    """Scores every window of the extractCookies grid and writes the blended
+    parking probability raster. Returns the number of windows and the
+    windows/sec throughput."""
+    lines, pixels = reader.shape[:2]
+    line_starts = range(offset, lines - window_size, stride)
+    pixel_starts = np.arange(offset, pixels - window_size, stride)
+
+    raster = ProbabilityRaster(output, reader, window_size,
+                               blendWeights(window_size, blend))
+    windows = 0
+    start = time.time()
+    for row, line in enumerate(line_starts):
+        raster.moveTo(line)
+        # One strip of the scene holds every window of the row
+        strip = reader.readWindow(line, 0, window_size, pixels)
+        for b in range(0, len(pixel_starts), batchsize):
+            batch_pixels = pixel_starts[b:b + batchsize]
+            batch = np.stack([strip[:, p:p + window_size]
+                              for p in batch_pixels])
+            probs = predict(preprocessWindows(batch, mean, crop_size))
+            for pixel, probability in zip(batch_pixels, probs):
+                raster.add(line, pixel, probability)
+            windows += len(batch_pixels)
+        sys.stderr.write('{} / {} rows, {:.1f} windows/sec\r'.format(
+            row + 1, len(line_starts), windows / (time.time() - start)))
+        sys.stderr.flush()
+    sys.stderr.write('\n')
+    raster.close()
+
+    elapsed = time.time() - start
+    return windows, windows / elapsed if elapsed > 0 else 0.
+
+
+def predictSceneDense(reader, model, mean, output, offset=200, rows=8,
+                      cols=64, label=1, blend='hann', samples=None):
+    """Dense version of predictScene with a fully-convolutional model
+    (``alex.AlexFCN``): every pass covers ``rows x cols`` windows of
+    ``model.insize`` at ``model.stride``, sharing their convolutions.
+
+    The cookies' per-window stretch to [0, 255] can not be shared between
+    windows: each pass is stretched by its own maximum, and the mean image
+    is replaced by its per-channel mean (see checkDense for the difference
+    it makes). The scores of the windows whose (line, pixel) is a key of the
+    dict ``samples`` are stored in it. Returns the number of windows and the
+    windows/sec throughput.
+    """
+    lines, pixels = reader.shape[:2]
+    size, stride = model.insize, model.stride
+    pass_lines = size + stride * (rows - 1)
+    pass_pixels = size + stride * (cols - 1)
+    channel_mean = mean.reshape(mean.shape[0], -1).mean(axis=1)
+
+    raster = ProbabilityRaster(output, reader, size, blendWeights(size, blend),
+                               pass_lines)
+    windows = 0
+    start = time.time()
+    for line in range(offset, lines - size + 1, stride * rows):
+        raster.moveTo(line)
+        strip = reader.readWindow(line, 0, pass_lines, pixels)
+        for pixel in range(offset, pixels - size + 1, stride * cols):
+            window = strip[:, pixel:pixel + pass_pixels]
+            top = max(window.max(), 1)
+            x = (window * (255.0 / top)).astype(np.uint8)
+            x = x.transpose(2, 0, 1)[None].astype(np.float32)
+            x -= channel_mean[None, :, None, None]
+            x *= (1.0 / 255.0)
+            scores = model.predict(x)[0, label]
+            for i in range(scores.shape[0]):
+                for j in range(scores.shape[1]):
+                    raster.add(line + i * stride, pixel + j * stride,
+                               scores[i, j])
+                    key = (line + i * stride, pixel + j * stride)
+                    if samples is not None and key in samples:
+                        samples[key] = float(scores[i, j])
+            windows += scores.size
+        sys.stderr.write('{} / {} lines, {:.1f} windows/sec\r'.format(
+            line, lines, windows / (time.time() - start)))
+        sys.stderr.flush()
+    sys.stderr.write('\n')
+    raster.close()
+
+    elapsed = time.time() - start
+    return windows, windows / elapsed if elapsed > 0 else 0.
+
+
+def checkDense(reader, model, mean, samples, label=1, batchsize=64):
+    """Compares dense scores with the preprocessing of training.
+
+    ``samples`` maps the (line, pixel) of windows of ``model.insize`` to
+    their score from predictSceneDense. Every window is scored again as
+    predictScene does, as the centre crop of the cookie around it (the size
+    of the mean image) stretched by its own maximum, minus the mean image.
+    Returns the number of windows compared, the mean and maximum absolute
+    difference of the probabilities, and the fraction of windows on the same
+    side of 0.5.
+    """
+    lines, pixels = reader.shape[:2]
+    size = mean.shape[1]
+    pad = (size - model.insize) // 2
+    keys = [(line, pixel) for (line, pixel), score in sorted(samples.items())
+            if score is not None and line >= pad and pixel >= pad and
+            line - pad + size <= lines and pixel - pad + size <= pixels]
+    if not keys:
+        return 0, 0., 0., 1.
+    exact = []
+    for b in range(0, len(keys), batchsize):
+        batch = np.stack([reader.readWindow(line - pad, pixel - pad, size, size)
+                          for line, pixel in keys[b:b + batchsize]])
+        x = preprocessWindows(batch, mean, model.insize)
+        exact.append(model.predict(x)[:, label].reshape(len(x)))
+    exact = np.concatenate(exact)
+    dense = np.array([samples[key] for key in keys])
+    diff = np.abs(dense - exact)
+    agreement = ((dense >= 0.5) == (exact >= 0.5)).mean()
+    return len(keys), diff.mean(), diff.max(), agreement
+
+
+def main():
+    archs = {
+        'alex': alex.Alex,
+        'googlenet': googlenet.GoogLeNet,
+        'parking_tiny': parkingnet.ParkingNetTiny,
+        'parking_small': parkingnet.ParkingNetSmall,
+        'parking_medium': parkingnet.ParkingNetMedium,
+    }
+
+    parser = argparse.ArgumentParser(
+        description='Parking probability map of a geotiff scene')
+    parser.add_argument('scene', help='Path to the geotiff scene')
+    parser.add_argument('model', help='Trained model (snapshot_object npz)')
+    parser.add_argument('--arch', '-a', choices=archs.keys(), default='alex',
+                        help='Convnet architecture')
+    parser.add_argument('--mean', '-m', default='mean.npy',
+                        help='Mean file (computed by compute_mean.py)')
+    parser.add_argument('--out', '-o', default='parking_probability.tif',
+                        help='Output probability geotiff')
+    parser.add_argument('--cookie_size', type=int, default=256,
+                        help='Window size, as the cookies of step2')
+    parser.add_argument('--stride', type=int, default=64,
+                        help='Window stride, as cookie_overlap of step2')
+    parser.add_argument('--offset', type=int, default=200,
+                        help='Black border of the scene to skip')
+    parser.add_argument('--batchsize', '-B', type=int, default=64,
+                        help='Windows per forward pass')
+    parser.add_argument('--blend', choices=('hann', 'mean'), default='hann',
+                        help='Weighting of overlapping windows')
+    parser.add_argument('--label', type=int, default=1,
+                        help='Class index of the parking label')
+    parser.add_argument('--dense', action='store_true',
+                        help='One fully-convolutional pass per block of '
+                        'windows (alex only), at the network stride')
+    parser.add_argument('--check', type=int, default=0,
+                        help='With --dense, score this many random windows '
+                        'again with the per-window preprocessing of training '
+                        'and print the difference')
+    parser.add_argument('--int8', action='store_true',
+                        help='The model is quantized (quantize_snapshot.py): '
+                        'about 4x less memory, no faster than float32')
+    args = parser.parse_args()
+
+    model = archs[args.arch]()
+    if args.int8:
+        if args.dense:
+            parser.error('--dense is not available for int8 models')
+        quantized.quantize_model(model, empty=True)
+    chainer.serializers.load_npz(args.model, model)
+    model.train = False
+    mean = np.load(args.mean).astype(np.float32)
+
+    def predict(x):
+        return model.predict(x)[:, args.label]
+
+    reader = geotiff.GeotiffReader(args.scene)
+    if args.dense:
+        if args.arch != 'alex':
+            parser.error('--dense is only available for alex')
+        fcn = alex.AlexFCN.from_alex(model)
+        lines, pixels = reader.shape[:2]
+        grid = [(line, pixel)
+                for line in range(args.offset, lines - fcn.insize + 1, fcn.stride)
+                for pixel in range(args.offset, pixels - fcn.insize + 1, fcn.stride)]
+        rng = np.random.RandomState(0)
+        chosen = rng.permutation(len(grid))[:args.check]
+        samples = dict((grid[i], None) for i in chosen)
+        windows, throughput = predictSceneDense(
+            reader, fcn, mean, args.out, args.offset, label=args.label,
+            blend=args.blend, samples=samples)
+        if samples:
+            count, mean_diff, max_diff, agreement = checkDense(
+                reader, fcn, mean, samples, args.label, args.batchsize)
+            print('dense vs per-window preprocessing on {} windows: mean '
+                  '|dp| {:.4f}, max |dp| {:.4f}, same side of 0.5: {:.3f}'
+                  .format(count, mean_diff, max_diff, agreement))
+    else:
+        windows, throughput = predictScene(
+            reader, predict, mean, model.insize, args.out, args.cookie_size,
+            args.stride, args.offset, args.batchsize, args.blend)
+    print('{} windows, {:.1f} windows/sec'.format(windows, throughput))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import json
+import os
+import numpy as np
+
+# A shard directory holds:
+#   shards.json      cookie_size, channels, shard_size and count
+#   shard_NNNNN.bin  shard_size fixed-size records, raw uint8 CHW cookies
+#   index.npy        int32 (count x 3) array of (label, line, pixel)
+#   records.txt      one record number per line, the list to split into
+#                    training and validation sets (like training_labels.csv,
+#                    in the order the cookies were selected, which may not
+#                    be the order they were written in)
+header_name = 'shards.json'
+index_name = 'index.npy'
+records_name = 'records.txt'
+
+def shardName(shard):
+    return 'shard_%05d.bin' % shard
+
+class ShardWriter(object):
+    '''
+    Appends cookies to fixed-record shard files. Use as a context manager or
+    call close() to write the index.
+    '''
+
+    def __init__(self, path, cookie_size, channels=3, shard_size=4096):
+        self.path = path
+        self.cookie_size = cookie_size
+        self.channels = channels
+        self.shard_size = shard_size
+        self.index = []
+        self.ranks = []
+        self._file = None
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def write(self, cookie, label, line, pixel, rank=None):
+        '''
+        cookie: (cookie_size x cookie_size x channels) uint8 array (HWC, as
+        cut from the geotiff); it is stored as CHW.
+        rank: position of the cookie in records.txt (the writing order by default)
+        '''
+        if cookie.shape != (self.cookie_size, self.cookie_size, self.channels):
+            raise ValueError("cookie of shape %s does not fit the shard records" % (cookie.shape,))
+        count = len(self.index)
+        if count % self.shard_size == 0:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(os.path.join(self.path, shardName(count // self.shard_size)), 'wb')
+        self._file.write(np.ascontiguousarray(cookie.transpose(2, 0, 1), dtype=np.uint8).tobytes())
+        self.index.append((label, line, pixel))
+        self.ranks.append(count if rank is None else rank)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        np.save(os.path.join(self.path, index_name),
+                np.array(self.index, dtype=np.int32).reshape(-1, 3))
+        with open(os.path.join(self.path, header_name), 'w') as f:
+            json.dump({'cookie_size': self.cookie_size, 'channels': self.channels,
+                       'shard_size': self.shard_size, 'count': len(self.index)}, f)
+        with open(os.path.join(self.path, records_name), 'w') as f:
+            f.writelines('%d\n' % i for i in np.argsort(self.ranks, kind='mergesort'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def isShardPath(path):
+    ''' True if path is a shard directory or a record list inside one '''
+    directory = path if os.path.isdir(path) else os.path.dirname(path)
+    return os.path.exists(os.path.join(directory, header_name))
+
+class ShardReader(object):
+    '''
+    Memory-mapped access to a shard directory.
+
+    path is the shard directory (all the records) or a text file in it with
+    one record number per line (a training or validation subset).
+    reader[i] returns a (channels x size x size) uint8 view and the label.
+    '''
+
+    def __init__(self, path):
+        if os.path.isdir(path):
+            self.directory = path
+            records = None
+        else:
+            self.directory = os.path.dirname(path)
+            records = np.loadtxt(path, dtype=np.int64, ndmin=1)
+        with open(os.path.join(self.directory, header_name)) as f:
+            header = json.load(f)
+        self.cookie_size = header['cookie_size']
+        self.channels = header['channels']
+        self.shard_size = header['shard_size']
+        self.count = header['count']
+        self.index = np.load(os.path.join(self.directory, index_name))
+        self.records = np.arange(self.count) if records is None else records
+
+        shape = (self.channels, self.cookie_size, self.cookie_size)
+        self.shards = []
+        for shard in range(-(-self.count // self.shard_size)):
+            n = min(self.shard_size, self.count - shard * self.shard_size)
+            self.shards.append(np.memmap(os.path.join(self.directory, shardName(shard)),
+                                         dtype=np.uint8, mode='r', shape=(n,) + shape))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        record = self.records[i]
+        image = self.shards[record // self.shard_size][record % self.shard_size]
+        return image, self.index[record, 0]
+
+    def coordinates(self, i):
+        ''' (line, pixel) of the cookie in the geotiff '''
+        record = self.records[i]
+        return tuple(int(c) for c in self.index[record, 1:])
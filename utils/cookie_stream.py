@@ -0,0 +1,94 @@
+import threading
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+class _Failure(object):
+    def __init__(self, error):
+        self.error = error
+
+_done = object()
+
+def readWindows(image, coords, size, max_queued=32):
+    '''
+    Yields (i, window) for every (line, pixel) of coords, the window being
+    image[line:line+size, pixel:pixel+size] (a numpy array or a
+    GeotiffReader).
+
+    The windows are read in raster order, so consecutive windows share the
+    blocks of the reader cache, by a thread that runs at most max_queued
+    windows ahead of the consumer: reading overlaps with what the consumer
+    does with the windows, and it waits when the consumer falls behind, so
+    the memory used does not depend on the number of windows. An error of
+    the reader is raised in the consumer; closing the generator stops the
+    reader.
+    '''
+    order = sorted(range(len(coords)), key=lambda i: (coords[i][0], coords[i][1]))
+    windows = queue.Queue(max_queued)
+    stop = threading.Event()
+
+    def put(item):
+        # Blocks while the queue is full, unless the consumer is gone
+        while not stop.is_set():
+            try:
+                windows.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for i in order:
+                line, pixel = coords[i]
+                if not put((i, image[line:line + size, pixel:pixel + size])):
+                    return
+            put(_done)
+        except Exception as e:
+            put(_Failure(e))
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            item = windows.get()
+            if item is _done:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        reader.join()
+
+if __name__ == "__main__":
+    # Read windows of a random image, with a slow consumer and an early stop:
+    # python -m utils.cookie_stream
+    import time
+    import numpy as np
+
+    image = np.random.RandomState(0).randint(0, 2000, size=(500, 600, 3))
+    coords = [(line, pixel) for pixel in range(0, 500, 40) for line in range(0, 400, 40)]
+    seen = set()
+    for i, window in readWindows(image, coords, 64, max_queued=4):
+        line, pixel = coords[i]
+        assert (window == image[line:line + 64, pixel:pixel + 64]).all()
+        seen.add(i)
+        time.sleep(0.001)
+    assert seen == set(range(len(coords)))
+
+    stream = readWindows(image, coords, 64, max_queued=2)
+    next(stream)
+    stream.close()
+    assert threading.active_count() == 1
+
+    try:
+        list(readWindows(image, [(0, 0), (1000, None)], 64))
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('the reader error was not raised')
+
+    print("windows streamed in raster order, with early stop and errors")
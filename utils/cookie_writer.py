@@ -0,0 +1,99 @@
+import multiprocessing
+import struct
+import zlib
+from collections import deque
+import numpy as np
+
+def scaleCookie(cookie_npy):
+    '''
+    Returns the cookie as uint8, stretched so that its maximum is 255 (the
+    scaling saveCookieAsPNG has always applied, truncating like the old
+    in-place multiplication did).
+    '''
+    cookie_max = cookie_npy.max()
+    if cookie_max == 0:
+        return np.zeros(cookie_npy.shape, dtype=np.uint8)
+    return (cookie_npy * (255.0 / cookie_max)).astype(np.uint8)
+
+def _chunk(tag, data):
+    chunk = tag + data
+    return struct.pack('>I', len(data)) + chunk + struct.pack('>I', zlib.crc32(chunk) & 0xffffffff)
+
+def encodePNG(image, level=6):
+    '''
+    Encodes a (height x width x 3) RGB or (height x width) grey uint8 array
+    as PNG bytes, compressing the array buffer directly with zlib.
+    '''
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    height, width = image.shape[:2]
+    color_type = 2 if image.ndim == 3 else 0
+    # Every scanline starts with its filter type, 0 (None)
+    raw = np.zeros((height, image[0].size + 1), dtype=np.uint8)
+    raw[:, 1:] = image.reshape(height, -1)
+    return (b'\x89PNG\r\n\x1a\n' +
+            _chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)) +
+            _chunk(b'IDAT', zlib.compress(raw.tobytes(), level)) +
+            _chunk(b'IEND', b''))
+
+def writePNG(path, image, level=6):
+    ''' Writes a uint8 image to path as PNG '''
+    with open(path, 'wb') as f:
+        f.write(encodePNG(image, level))
+
+def _writePNGTask(args):
+    writePNG(*args)
+
+class CookieWriter(object):
+    '''
+    Writes cookies as PNG files from a pool of processes.
+
+    Cookies are scaled to uint8 in the caller (which halves what is sent to
+    the workers) and encoded in the pool. At most max_inflight writes are
+    pending at any time: write() blocks on the oldest one when the limit is
+    reached, so memory stays bounded however many cookies are written.
+    Worker errors are raised in the caller.
+    '''
+
+    def __init__(self, processes=None, max_inflight=None, level=6):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.max_inflight = max_inflight or 4 * self.processes
+        self.level = level
+        self.pool = multiprocessing.Pool(self.processes) if self.processes > 1 else None
+        self.pending = deque()
+        self.written = 0
+
+    def write(self, path, cookie_npy):
+        '''
+        Queues cookie_npy (raw geotiff values) to be saved as path. Returns
+        the uint8 image that is written.
+        '''
+        args = (path, scaleCookie(cookie_npy), self.level)
+        if self.pool is None:
+            _writePNGTask(args)
+        else:
+            while len(self.pending) >= self.max_inflight:
+                self.pending.popleft().get()
+            self.pending.append(self.pool.apply_async(_writePNGTask, (args,)))
+        self.written += 1
+        return args[1]
+
+    def close(self):
+        ''' Waits for all pending writes and stops the workers '''
+        try:
+            while self.pending:
+                self.pending.popleft().get()
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+            self.pending.clear()
+        self.close()
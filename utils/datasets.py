@@ -0,0 +1,121 @@
+import json
+import os
+
+import numpy as np
+
+import chainer
+
+from utils import cookie_shards
+from utils import virtual_cookies
+
+
+class ShardedCookieDataset(chainer.dataset.DatasetMixin):
+
+    """Cookies read from the shards written by step2 (no file per cookie).
+
+    The shards are memory-mapped, so an example is a slice of the mapped
+    file cast to ``dtype``: no PNG decode and no file open per image.
+    Returns ``(image, label)`` like ``LabeledImageDataset``.
+    """
+
+    def __init__(self, path, dtype=np.float32, label_dtype=np.int32):
+        self.reader = cookie_shards.ShardReader(path)
+        self.dtype = dtype
+        self.label_dtype = label_dtype
+
+    def __len__(self):
+        return len(self.reader)
+
+    def get_example(self, i):
+        image, label = self.reader[i]
+        return (np.array(image, dtype=self.dtype),
+                np.array(label, dtype=self.label_dtype))
+
+
+class VirtualCookieDataset(chainer.dataset.DatasetMixin):
+
+    """Cookies cropped on demand from the scene, from ``(line, pixel, label)``
+    records written by step2 (no cookie file ever exists).
+
+    Changing the cookie grid or the sampling only rewrites the records.
+    Returns ``(image, label)`` like ``LabeledImageDataset``.
+    """
+
+    def __init__(self, path, dtype=np.float32, label_dtype=np.int32):
+        self.reader = virtual_cookies.VirtualCookieReader(path)
+        self.dtype = dtype
+        self.label_dtype = label_dtype
+
+    def __len__(self):
+        return len(self.reader)
+
+    def get_example(self, i):
+        image, label = self.reader[i]
+        return (np.array(image, dtype=self.dtype),
+                np.array(label, dtype=self.label_dtype))
+
+
+class ConcatenatedDataset(chainer.dataset.DatasetMixin):
+
+    """Examples of several datasets one after the other, e.g. the cookies of
+    every scene of a batch."""
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.offsets = np.cumsum([0] + [len(d) for d in datasets])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def get_example(self, i):
+        k = np.searchsorted(self.offsets, i, side='right') - 1
+        return self.datasets[k][i - self.offsets[k]]
+
+
+def datasetList(path, root='.'):
+    """The shard or virtual cookie directories listed one per line by the
+    file ``path`` (relative to ``root``), or None for any other file."""
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    paths = [os.path.join(root, line) for line in lines]
+    if not paths or not all(cookie_shards.isShardPath(p) or
+                            virtual_cookies.isVirtualPath(p) for p in paths):
+        return None
+    return paths
+
+
+def openDataset(path, root='.', dtype=np.float32):
+    """Image-label dataset for a list file of PNGs, cookie shards, virtual
+    cookie records, or a list of shard and record directories, returning
+    images of the given dtype."""
+    if cookie_shards.isShardPath(path):
+        return ShardedCookieDataset(path, dtype)
+    if virtual_cookies.isVirtualPath(path):
+        return VirtualCookieDataset(path, dtype)
+    paths = datasetList(path, root)
+    if paths is not None:
+        return ConcatenatedDataset([openDataset(p, root, dtype) for p in paths])
+    return chainer.datasets.LabeledImageDataset(path, root, dtype)
+
+
+def datasetFiles(path, root='.'):
+    """Files read by the dataset ``openDataset(path, root)``: the shard or
+    virtual cookie directory (plus the scene of virtual cookies),
+    the files of every directory of a dataset list, or the list file and
+    every image it lists."""
+    directory = path if os.path.isdir(path) else os.path.dirname(path)
+    if cookie_shards.isShardPath(path):
+        return [directory]
+    if virtual_cookies.isVirtualPath(path):
+        with open(os.path.join(directory, virtual_cookies.header_name)) as f:
+            header = json.load(f)
+        return [directory, header['scene']]
+    paths = datasetList(path, root)
+    if paths is not None:
+        return [path] + sum([datasetFiles(p, root) for p in paths], [])
+    with open(path) as f:
+        images = [os.path.join(root, line.split()[0])
+                  for line in f if line.strip()]
+    return [path] + images
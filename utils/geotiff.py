@@ -0,0 +1,126 @@
+import gdal
+import numpy as np
+from collections import OrderedDict
+
+class GeotiffReader(object):
+    '''
+    Windowed, read-only access to a geotiff as a (lines, pixels, bands) array.
+
+    Pixels are read through GDAL windowed reads in blocks aligned to the
+    file's native block size, and the most recently used blocks are kept in
+    a cache bounded by cache_bytes. Peak memory depends on the window and
+    cache size, not on the size of the scene.
+
+    The reader can be sliced like the numpy array returned by the old
+    loadGeotiff (image[line0:line1, pixel0:pixel1]) and exposes .shape.
+    '''
+
+    def __init__(self, path, bands=(3, 2, 1), cache_bytes=256 * 2**20,
+                 min_block=256):
+        '''
+        path: geotiff file name
+        bands: GDAL band indexes in output channel order (default R,G,B)
+        cache_bytes: upper bound of the memory used by cached blocks
+        min_block: blocks smaller than this (e.g. one-line strips) are
+                   grouped by whole multiples of the native block size
+        '''
+        self.path = path
+        self.dataset = gdal.Open(path, gdal.GA_ReadOnly)
+        if self.dataset is None:
+            raise IOError("Cannot open geotiff %s" % path)
+        self.geo_transform = self.dataset.GetGeoTransform()
+        self.projection = self.dataset.GetProjection()
+        self.bands = [self.dataset.GetRasterBand(b) for b in bands]
+        self.shape = (self.dataset.RasterYSize, self.dataset.RasterXSize,
+                      len(self.bands))
+        self.dtype = self.bands[0].ReadAsArray(0, 0, 1, 1).dtype
+
+        native_pixels, native_lines = self.bands[0].GetBlockSize()
+        self.block_size = (self._groupBlock(native_lines, min_block, self.shape[0]),
+                           self._groupBlock(native_pixels, min_block, self.shape[1]))
+
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _groupBlock(native, min_block, limit):
+        ''' Smallest multiple of the native block size >= min_block '''
+        native = max(native, 1)
+        size = native * max(1, -(-min_block // native))
+        return min(size, limit)
+
+    def _block(self, block_line, block_pixel):
+        ''' Returns the cached block at the given block grid position '''
+        key = (block_line, block_pixel)
+        block = self._cache.pop(key, None)
+        if block is not None:
+            self.hits += 1
+            self._cache[key] = block
+            return block
+
+        self.misses += 1
+        bh, bw = self.block_size
+        line = block_line * bh
+        pixel = block_pixel * bw
+        height = min(bh, self.shape[0] - line)
+        width = min(bw, self.shape[1] - pixel)
+        block = np.dstack([band.ReadAsArray(pixel, line, width, height)
+                           for band in self.bands])
+
+        self._cache[key] = block
+        self._cached_bytes += block.nbytes
+        while self._cached_bytes > self.cache_bytes and len(self._cache) > 1:
+            _, old = self._cache.popitem(last=False)
+            self._cached_bytes -= old.nbytes
+        return block
+
+    def readWindow(self, line, pixel, height, width=None):
+        '''
+        Returns a copy of the window starting at (line, pixel) with size
+        (height, width), clipped to the raster like a numpy slice.
+        '''
+        if width is None:
+            width = height
+        line0, line1 = max(line, 0), min(line + height, self.shape[0])
+        pixel0, pixel1 = max(pixel, 0), min(pixel + width, self.shape[1])
+        out = np.empty((max(line1 - line0, 0), max(pixel1 - pixel0, 0),
+                        self.shape[2]), dtype=self.dtype)
+        if out.size == 0:
+            return out
+
+        bh, bw = self.block_size
+        for block_line in range(line0 // bh, (line1 - 1) // bh + 1):
+            for block_pixel in range(pixel0 // bw, (pixel1 - 1) // bw + 1):
+                block = self._block(block_line, block_pixel)
+                # Intersection of the window with this block
+                l0 = max(line0, block_line * bh)
+                l1 = min(line1, (block_line + 1) * bh)
+                p0 = max(pixel0, block_pixel * bw)
+                p1 = min(pixel1, (block_pixel + 1) * bw)
+                out[l0 - line0:l1 - line0, p0 - pixel0:p1 - pixel0] = \
+                    block[l0 - block_line * bh:l1 - block_line * bh,
+                          p0 - block_pixel * bw:p1 - block_pixel * bw]
+        return out
+
+    def __getitem__(self, key):
+        ''' image[line0:line1, pixel0:pixel1] with unit steps '''
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        lines, pixels = key[0], key[1]
+        line0, line1, line_step = lines.indices(self.shape[0])
+        pixel0, pixel1, pixel_step = pixels.indices(self.shape[1])
+        if line_step != 1 or pixel_step != 1:
+            raise IndexError("GeotiffReader only supports unit-step slices")
+        window = self.readWindow(line0, pixel0, line1 - line0, pixel1 - pixel0)
+        if len(key) > 2:
+            window = window[(slice(None), slice(None)) + tuple(key[2:])]
+        return window
+
+    def close(self):
+        self._cache.clear()
+        self._cached_bytes = 0
+        self.bands = []
+        self.dataset = None
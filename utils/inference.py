@@ -0,0 +1,7 @@
+import chainer
+
+def volatile(x):
+    ''' Input variable of the models' predict methods, which does not keep the computational graph '''
+    if isinstance(x, chainer.Variable):
+        x = x.data
+    return chainer.Variable(x, volatile='on')
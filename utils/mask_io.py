@@ -0,0 +1,136 @@
+import json
+import struct
+import numpy as np
+
+# File layout: magic, header length (uint32 little endian), json header,
+# then the tiles in row-major tile order. Every tile has the same number of
+# bytes (edge tiles are zero padded), so a tile is found by its index alone.
+_magic = b'PMASK\x00\x01\x00'
+
+def saveMask(path, mask, tile=256, packed=True):
+    '''
+    Saves a binary (lines x pixels) mask as uint8 tiles of tile x tile cells,
+    bit-packed (8 cells per byte) if packed is True.
+    '''
+    if tile % 8:
+        raise ValueError("tile size must be a multiple of 8")
+    lines, pixels = mask.shape[:2]
+    header = json.dumps({'shape': [int(lines), int(pixels)], 'tile': int(tile),
+                         'packed': bool(packed)}).encode('ascii')
+
+    with open(path, 'wb') as f:
+        f.write(_magic)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        buf = np.zeros((tile, tile), dtype=np.uint8)
+        for line in range(0, lines, tile):
+            for pixel in range(0, pixels, tile):
+                block = np.asarray(mask[line:line + tile, pixel:pixel + tile])
+                buf[:] = 0
+                buf[:block.shape[0], :block.shape[1]] = block != 0
+                f.write((np.packbits(buf) if packed else buf).tobytes())
+
+class ParkingMask(object):
+    '''
+    Memory-mapped view of a mask written by saveMask.
+
+    Slicing (mask[l0:l1, p0:p1]) decodes only the tiles the window touches,
+    so only those pages are read from disk. Values are uint8 0/1.
+    '''
+
+    def __init__(self, path, mode='r'):
+        '''
+        mode: 'r' read-only, or 'r+' to update windows in place (writeWindow)
+        '''
+        with open(path, 'rb') as f:
+            if f.read(len(_magic)) != _magic:
+                raise IOError("%s is not a parking mask file" % path)
+            size, = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(size).decode('ascii'))
+        self.path = path
+        self.shape = tuple(header['shape'])
+        self.tile = header['tile']
+        self.packed = header['packed']
+        self.dtype = np.dtype(np.uint8)
+        self.ndim = 2
+
+        self.tile_grid = (-(-self.shape[0] // self.tile), -(-self.shape[1] // self.tile))
+        tile_bytes = self.tile * self.tile // (8 if self.packed else 1)
+        self.tiles = np.memmap(path, dtype=np.uint8, mode=mode,
+                               offset=len(_magic) + 4 + size,
+                               shape=self.tile_grid + (tile_bytes,))
+
+    def getTile(self, tile_line, tile_pixel):
+        ''' Returns the decoded (tile x tile) uint8 tile at the given grid position '''
+        raw = self.tiles[tile_line, tile_pixel]
+        if self.packed:
+            raw = np.unpackbits(raw)
+        return np.asarray(raw).reshape(self.tile, self.tile)
+
+    def __getitem__(self, key):
+        ''' mask[line0:line1, pixel0:pixel1] with unit steps, or mask[line, pixel] '''
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        slices = []
+        squeeze = []
+        for axis, k in enumerate(key):
+            if not isinstance(k, slice):
+                k = int(k) % self.shape[axis]
+                k = slice(k, k + 1)
+                squeeze.append(axis)
+            slices.append(k)
+        if squeeze:
+            return self[tuple(slices)].squeeze(axis=tuple(squeeze))[()]
+
+        line0, line1, line_step = slices[0].indices(self.shape[0])
+        pixel0, pixel1, pixel_step = slices[1].indices(self.shape[1])
+        if line_step != 1 or pixel_step != 1:
+            raise IndexError("ParkingMask only supports unit-step slices")
+
+        out = np.zeros((max(line1 - line0, 0), max(pixel1 - pixel0, 0)), dtype=np.uint8)
+        if out.size == 0:
+            return out
+        t = self.tile
+        for tl in range(line0 // t, (line1 - 1) // t + 1):
+            for tp in range(pixel0 // t, (pixel1 - 1) // t + 1):
+                l0, l1 = max(line0, tl * t), min(line1, (tl + 1) * t)
+                p0, p1 = max(pixel0, tp * t), min(pixel1, (tp + 1) * t)
+                out[l0 - line0:l1 - line0, p0 - pixel0:p1 - pixel0] = \
+                    self.getTile(tl, tp)[l0 - tl * t:l1 - tl * t, p0 - tp * t:p1 - tp * t]
+        return out
+
+    def writeWindow(self, line, pixel, block):
+        '''
+        Sets the cells of the window starting at (line, pixel) to block != 0
+        (clipped to the mask); only the tiles the window touches are
+        re-encoded and written. The mask must be opened with mode 'r+'.
+        '''
+        line1 = min(line + block.shape[0], self.shape[0])
+        pixel1 = min(pixel + block.shape[1], self.shape[1])
+        if line1 <= max(line, 0) or pixel1 <= max(pixel, 0):
+            return
+        t = self.tile
+        for tl in range(max(line, 0) // t, (line1 - 1) // t + 1):
+            for tp in range(max(pixel, 0) // t, (pixel1 - 1) // t + 1):
+                l0, l1 = max(line, tl * t, 0), min(line1, (tl + 1) * t)
+                p0, p1 = max(pixel, tp * t, 0), min(pixel1, (tp + 1) * t)
+                tile = self.getTile(tl, tp).copy()
+                tile[l0 - tl * t:l1 - tl * t, p0 - tp * t:p1 - tp * t] = \
+                    block[l0 - line:l1 - line, p0 - pixel:p1 - pixel] != 0
+                self.tiles[tl, tp] = np.packbits(tile) if self.packed else tile.ravel()
+
+    def flush(self):
+        self.tiles.flush()
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:, :]
+        return out if dtype is None else out.astype(dtype)
+
+def openMask(path):
+    '''
+    Opens a parking mask memory-mapped: .npy files (as written by the old
+    step1) through np.load, anything else as a ParkingMask file.
+    '''
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    return ParkingMask(path)
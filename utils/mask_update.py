@@ -0,0 +1,149 @@
+import hashlib
+import json
+from collections import Counter
+
+import numpy as np
+
+from utils import rasterize
+
+# The manifest of a parking mask records, for the raster it was drawn on,
+# the geometry hash and the (line, pixel) bounding box of every shapefile
+# record, so that the next run only redraws what the annotators changed.
+
+def recordHash(shape):
+    ''' sha1 of the geometry (points and parts) of a shapefile record '''
+    digest = hashlib.sha1()
+    digest.update(np.asarray(shape.points, dtype=np.float64).tobytes())
+    digest.update(np.asarray(getattr(shape, 'parts', []), dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+def rasterKey(reader):
+    ''' What the mask depends on besides the polygons: size and georeferencing '''
+    return {'shape': [int(n) for n in reader.shape[:2]],
+            'geo_transform': [float(v) for v in reader.geo_transform],
+            'projection': reader.projection}
+
+def saveManifest(path, raster_key, hashes, boxes):
+    with open(path, 'w') as f:
+        json.dump({'raster': raster_key, 'hashes': list(hashes),
+                   'boxes': np.asarray(boxes, dtype=np.int64).tolist()}, f)
+
+def loadManifest(path):
+    ''' The manifest saved at path, or None if there is none '''
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def loadChanges(path):
+    ''' The pending changes saved at path, or None if there are none '''
+    return loadManifest(path)
+
+def addChanges(path, boxes=None):
+    '''
+    Adds the redrawn boxes to the pending changes of the mask at path, for
+    the cookie labels to be updated; boxes=None marks the whole mask as
+    changed. Changes pile up until the consumer (step2) removes the file.
+    '''
+    changes = loadChanges(path) or {'full': False, 'boxes': []}
+    if boxes is None:
+        changes = {'full': True, 'boxes': []}
+    elif not changes['full']:
+        changes['boxes'].extend(np.asarray(boxes, dtype=np.int64).reshape(-1, 4).tolist())
+    with open(path, 'w') as f:
+        json.dump(changes, f)
+
+def changedRecords(old_hashes, new_hashes):
+    '''
+    Compares the records of two versions of the shapefile by geometry, so
+    reordering the records changes nothing. Returns the indices of the new
+    records that are added (or modified) and of the old records that are
+    removed (or modified).
+    '''
+    remaining = Counter(old_hashes)
+    added = []
+    for i, h in enumerate(new_hashes):
+        if remaining[h] > 0:
+            remaining[h] -= 1
+        else:
+            added.append(i)
+    kept = Counter(new_hashes)
+    removed = []
+    for i, h in enumerate(old_hashes):
+        if kept[h] > 0:
+            kept[h] -= 1
+        else:
+            removed.append(i)
+    return added, removed
+
+def updateMask(mask, index, boxes):
+    '''
+    Redraws the (line0, pixel0, line1, pixel1) boxes of the mask (upper
+    bounds excluded) from the polygons of the PolygonIndex index: every box
+    is cleared, then every polygon that intersects it is filled again,
+    clipped to the box, so the lots that overlap a removed or moved lot keep
+    their cells. mask is a numpy array or a ParkingMask opened with 'r+'.
+    Returns the number of cells redrawn.
+    '''
+    cells = 0
+    for line0, pixel0, line1, pixel1 in np.asarray(boxes, dtype=np.int64).reshape(-1, 4):
+        line0, pixel0 = max(line0, 0), max(pixel0, 0)
+        line1, pixel1 = min(line1, mask.shape[0]), min(pixel1, mask.shape[1])
+        if line0 >= line1 or pixel0 >= pixel1:
+            continue
+        region = np.zeros((line1 - line0, pixel1 - pixel0), dtype=np.uint8)
+        for i in index.query(line0, pixel0, line1 - line0, pixel1 - pixel0):
+            # Integer shifts keep the scanline fill identical
+            rasterize.fillPolygon(region, index.polygon(i) - [line0, pixel0])
+        if hasattr(mask, 'writeWindow'):
+            mask.writeWindow(line0, pixel0, region)
+        else:
+            mask[line0:line1, pixel0:pixel1] = region
+        cells += region.size
+    return cells
+
+if __name__ == "__main__":
+    # Edit random lots and compare the updated mask with a full redraw:
+    # python -m utils.mask_update
+    from utils import polygon_index
+
+    class Shape(object):
+        def __init__(self, points):
+            self.points = points
+            self.parts = [0]
+
+    rng = np.random.RandomState(0)
+    size = (400, 500)
+
+    def randomLot():
+        center = rng.randint(0, 450, size=2)
+        return (center + rng.randint(-30, 30, size=(rng.randint(3, 7), 2))).tolist()
+
+    lots = [randomLot() for _ in range(80)]
+    for trial in range(20):
+        index = polygon_index.PolygonIndex([np.array(lot) for lot in lots])
+        mask = rasterize.rasterizePolygons(size, [np.array(lot) for lot in lots])
+        hashes = [recordHash(Shape(lot)) for lot in lots]
+
+        edited = list(lots)
+        for _ in range(rng.randint(1, 6)):
+            action = rng.randint(3)
+            if action == 0 and edited:
+                edited.pop(rng.randint(len(edited)))
+            elif action == 1 and edited:
+                edited[rng.randint(len(edited))] = randomLot()
+            else:
+                edited.insert(rng.randint(len(edited) + 1), randomLot())
+        rng.shuffle(edited)
+
+        new_index = polygon_index.PolygonIndex([np.array(lot) for lot in edited])
+        added, removed = changedRecords(hashes, [recordHash(Shape(lot)) for lot in edited])
+        boxes = np.concatenate([index.boxes[removed], new_index.boxes[added]])
+        updateMask(mask, new_index, boxes)
+
+        expected = rasterize.rasterizePolygons(size, [np.array(lot) for lot in edited])
+        assert (mask == expected).all(), trial
+        lots = edited
+
+    print("incremental updates match the full redraw on 20 random edits")
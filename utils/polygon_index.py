@@ -0,0 +1,146 @@
+import numpy as np
+
+from utils import rasterize
+
+class PolygonIndex(object):
+    '''
+    Packed R-tree over the bounding boxes of the parking polygons.
+
+    The tree is built once with the Sort-Tile-Recursive packing: the boxes
+    are sorted into vertical slabs, then along each slab, and grouped by
+    node_size; every upper level groups node_size consecutive nodes of the
+    level below. A window query visits only the nodes whose box intersects
+    it, so its cost depends on the number of polygons near the window, not
+    on the number of polygons of the scene.
+
+    Boxes are in (line, pixel) cells with the upper bounds excluded, the
+    same cells rasterize.fillPolygon visits.
+    '''
+
+    def __init__(self, polygons, node_size=16):
+        '''
+        polygons: list of ray_algorithm.Polygon or (n, 2) (line, pixel) arrays,
+            as returned by getPolygons in step1
+        node_size: number of children of every node
+        '''
+        coords = [np.column_stack(rasterize.polygonCoords(p)) for p in polygons]
+        self.vertices = np.concatenate(coords) if coords else np.zeros((0, 2))
+        self.offsets = np.cumsum([0] + [len(c) for c in coords]).astype(np.int64)
+        self.boxes = np.array([[np.trunc(c[:, 0].min()), np.trunc(c[:, 1].min()),
+                                np.trunc(c[:, 0].max()), np.trunc(c[:, 1].max())]
+                               for c in coords], dtype=np.int64).reshape(-1, 4)
+        self.node_size = node_size
+        self.order = self._pack(self.boxes, node_size)
+        self._buildLevels()
+
+    @staticmethod
+    def _pack(boxes, node_size):
+        # Sort-Tile-Recursive order of the boxes
+        n = len(boxes)
+        if n == 0:
+            return np.zeros(0, dtype=np.int64)
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2.0
+        num_nodes = -(-n // node_size)
+        slab_size = node_size * int(np.ceil(np.sqrt(num_nodes)))
+        by_line = np.argsort(centers[:, 0], kind='mergesort')
+        order = []
+        for start in range(0, n, slab_size):
+            slab = by_line[start:start + slab_size]
+            order.append(slab[np.argsort(centers[slab, 1], kind='mergesort')])
+        return np.concatenate(order)
+
+    def _buildLevels(self):
+        # levels[0] are the boxes in packed order, levels[-1] the root(s)
+        level = self.boxes[self.order]
+        self.levels = [level]
+        while len(level) > self.node_size:
+            padded = -(-len(level) // self.node_size) * self.node_size
+            lows = np.full((padded, 2), np.iinfo(np.int64).max, dtype=np.int64)
+            highs = np.full((padded, 2), np.iinfo(np.int64).min, dtype=np.int64)
+            lows[:len(level)] = level[:, :2]
+            highs[:len(level)] = level[:, 2:]
+            level = np.hstack([lows.reshape(-1, self.node_size, 2).min(axis=1),
+                               highs.reshape(-1, self.node_size, 2).max(axis=1)])
+            self.levels.append(level)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def polygon(self, i):
+        ''' Returns the (n, 2) (line, pixel) vertices of polygon i '''
+        return self.vertices[self.offsets[i]:self.offsets[i + 1]]
+
+    def query(self, line, pixel, height, width=None):
+        '''
+        Returns the sorted indices of the polygons whose bounding box
+        intersects the window [line, line+height) x [pixel, pixel+width).
+        '''
+        if width is None:
+            width = height
+        line_end, pixel_end = line + height, pixel + width
+        top = len(self.levels) - 1
+        nodes = np.arange(len(self.levels[top]))
+        for depth in range(top, -1, -1):
+            if depth < top:
+                # Children of the nodes hit at the level above
+                children = (nodes[:, None] * self.node_size + np.arange(self.node_size)).ravel()
+                nodes = children[children < len(self.levels[depth])]
+            boxes = self.levels[depth][nodes]
+            hit = ((boxes[:, 0] < line_end) & (boxes[:, 2] > line) &
+                   (boxes[:, 1] < pixel_end) & (boxes[:, 3] > pixel))
+            nodes = nodes[hit]
+        return np.sort(self.order[nodes])
+
+    def queryPolygons(self, line, pixel, height, width=None):
+        ''' Returns the vertices of the polygons that query() finds '''
+        return [self.polygon(i) for i in self.query(line, pixel, height, width)]
+
+    def save(self, path):
+        ''' Saves the index (polygons included) to an .npz file '''
+        with open(path, 'wb') as f:
+            np.savez(f, vertices=self.vertices, offsets=self.offsets,
+                     boxes=self.boxes, order=self.order,
+                     node_size=np.int64(self.node_size))
+
+def loadPolygonIndex(path):
+    '''
+    Loads an index saved by PolygonIndex.save without re-packing it.
+    '''
+    data = np.load(path)
+    index = PolygonIndex.__new__(PolygonIndex)
+    index.vertices = data['vertices']
+    index.offsets = data['offsets']
+    index.boxes = data['boxes']
+    index.order = data['order']
+    index.node_size = int(data['node_size'])
+    index._buildLevels()
+    return index
+
+if __name__ == "__main__":
+    # Compare the window queries with a scan of all the boxes:
+    # python -m utils.polygon_index
+    import tempfile, os
+
+    rng = np.random.RandomState(0)
+    polygons = []
+    for _ in range(2000):
+        center = rng.randint(0, 5000, size=2)
+        polygons.append(center + rng.randint(-40, 40, size=(rng.randint(3, 8), 2)))
+    index = PolygonIndex(polygons, node_size=8)
+
+    fd, path = tempfile.mkstemp(suffix='.npz')
+    os.close(fd)
+    index.save(path)
+    loaded = loadPolygonIndex(path)
+    os.remove(path)
+
+    for trial in range(500):
+        line, pixel = rng.randint(-100, 5100, size=2)
+        size = rng.randint(1, 400)
+        b = index.boxes
+        expected = np.nonzero((b[:, 0] < line + size) & (b[:, 2] > line) &
+                              (b[:, 1] < pixel + size) & (b[:, 3] > pixel))[0]
+        assert (index.query(line, pixel, size) == expected).all(), trial
+        assert (loaded.query(line, pixel, size) == expected).all(), trial
+
+    print("window queries match the scan of all the boxes on 500 windows")
@@ -0,0 +1,166 @@
+import atexit
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+# Set to the output path to profile a whole run without changing the code,
+# e.g. PARKOPEDIA_PROFILE=trace.json python step2_segment_image.py
+_env_var = 'PARKOPEDIA_PROFILE'
+
+_path = None
+_owner = None
+_events = []
+_lock = threading.Lock()
+_origin = time.time()
+
+def _cpuTime():
+    times = os.times()
+    return times[0] + times[1]
+
+def _peakRSS():
+    ''' High-water mark of the resident memory of the process, in MB '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024.  # bytes on OS X, KB on Linux
+    return peak / 1024.
+
+def enable(path):
+    '''
+    Switches the instrumentation on; the stages are written to path when the
+    process exits: as a Chrome trace (chrome://tracing, Perfetto) if path
+    ends with .json, as one JSON record per line otherwise.
+    '''
+    global _path, _owner
+    if _path is None:
+        atexit.register(save)
+    _path = path
+    # Only this process writes the file; forked workers keep their records
+    _owner = os.getpid()
+
+def enabled():
+    return _path is not None
+
+class Stage(object):
+    '''
+    Measures one run of a stage: wall time, CPU time, peak memory and the
+    number of items processed (set with add() or by the caller).
+    '''
+
+    def __init__(self, name, items=None):
+        self.name = name
+        self.items = items
+
+    def add(self, count=1):
+        self.items = (self.items or 0) + count
+
+    def __enter__(self):
+        self.rss_start = _peakRSS()
+        self.cpu_start = _cpuTime()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.time() - self.start
+        record = {
+            'name': self.name,
+            'start': self.start - _origin,
+            'wall_time': wall,
+            'cpu_time': _cpuTime() - self.cpu_start,
+            'peak_rss_mb': _peakRSS(),
+            'rss_growth_mb': _peakRSS() - self.rss_start,
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+        }
+        if self.items is not None:
+            record['items'] = self.items
+            record['items_per_sec'] = self.items / wall if wall > 0 else 0.
+        with _lock:
+            _events.append(record)
+        sys.stderr.write('[profile] %s: %.3fs wall, %.3fs cpu, %.1f MB peak%s\n' % (
+            self.name, wall, record['cpu_time'], record['peak_rss_mb'],
+            ', %d items (%.1f/s)' % (self.items, record['items_per_sec'])
+            if self.items is not None else ''))
+        return False
+
+class _NullStage(object):
+    ''' Stage used when the instrumentation is off: it measures nothing '''
+
+    def add(self, count=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_stage = _NullStage()
+
+def stage(name, items=None):
+    '''
+    Context manager around a stage:
+
+        with profiling.stage('saveImages', items=len(cookies)) as s:
+            ...
+            s.add(n)  # or count the items as they are processed
+    '''
+    if _path is None:
+        return _null_stage
+    return Stage(name, items)
+
+def profiled(name=None, items=None):
+    '''
+    Decorator version of stage(). items is an optional function of the
+    return value giving the number of items processed (e.g. len).
+    '''
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _path is None:
+                return func(*args, **kwargs)
+            with Stage(stage_name) as s:
+                result = func(*args, **kwargs)
+                if items is not None:
+                    s.items = items(result)
+            return result
+        return wrapper
+    return decorator
+
+def events():
+    ''' The stages measured so far, as a list of dicts '''
+    with _lock:
+        return list(_events)
+
+def chromeTrace(records):
+    ''' Chrome trace events (complete events, times in microseconds) '''
+    trace = []
+    for r in records:
+        args = dict((k, r[k]) for k in ('cpu_time', 'peak_rss_mb', 'rss_growth_mb', 'items', 'items_per_sec') if k in r)
+        trace.append({'name': r['name'], 'cat': 'stage', 'ph': 'X',
+                      'ts': r['start'] * 1e6, 'dur': r['wall_time'] * 1e6,
+                      'pid': r['pid'], 'tid': r['tid'], 'args': args})
+    return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+def save(path=None):
+    ''' Writes the measured stages (done at exit when enabled) '''
+    if path is None and os.getpid() != _owner:
+        return
+    path = path or _path
+    records = events()
+    if path is None or not records:
+        return
+    with open(path, 'w') as f:
+        if path.endswith('.json'):
+            json.dump(chromeTrace(records), f)
+        else:
+            for r in records:
+                f.write(json.dumps(r, sort_keys=True) + '\n')
+
+if os.environ.get(_env_var):
+    enable(os.environ[_env_var])
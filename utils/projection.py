@@ -0,0 +1,94 @@
+import numpy as np
+import osr
+
+def utmSpatialReference(lon, lat):
+    '''
+    WGS84 UTM spatial reference of the zone containing the mean of lon/lat.
+    Used when the raster carries no projection, as utm.from_latlon did.
+    '''
+    lon_c = float(np.mean(lon))
+    lat_c = float(np.mean(lat))
+    srs = osr.SpatialReference()
+    srs.SetWellKnownGeogCS('WGS84')
+    srs.SetUTM(int((lon_c + 180) // 6) % 60 + 1, int(lat_c >= 0))
+    return srs
+
+def _traditionalAxisOrder(srs):
+    ''' Keep (lon, lat) / (x, y) axis order with GDAL >= 3 '''
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+def lonLatToWorld(lon, lat, projection=None):
+    '''
+    Projects arrays of WGS84 lon/lat into the coordinate system of the raster
+    with a single OSR TransformPoints call.
+
+    Arguments
+    ---------
+
+    lon, lat : numpy arrays
+        WGS84 coordinates in degrees
+
+    projection : str
+        WKT of the raster (gdal Dataset.GetProjection()). When empty, the
+        UTM zone of the points is used.
+
+    '''
+    lon = np.asarray(lon, dtype=np.float64).ravel()
+    lat = np.asarray(lat, dtype=np.float64).ravel()
+    if lon.size == 0:
+        return np.empty(0), np.empty(0)
+
+    src = osr.SpatialReference()
+    src.ImportFromEPSG(4326)
+    if projection:
+        dst = osr.SpatialReference(wkt=projection)
+    else:
+        dst = utmSpatialReference(lon, lat)
+    transform = osr.CoordinateTransformation(_traditionalAxisOrder(src),
+                                             _traditionalAxisOrder(dst))
+
+    world = np.asarray(transform.TransformPoints(np.column_stack([lon, lat]).tolist()))
+    return world[:, 0], world[:, 1]
+
+def worldToLonLat(x, y, projection):
+    '''
+    Inverse of lonLatToWorld: WGS84 lon/lat arrays of world coordinates x, y
+    in the coordinate system given by the WKT projection.
+    '''
+    x = np.asarray(x, dtype=np.float64).ravel()
+    y = np.asarray(y, dtype=np.float64).ravel()
+    if x.size == 0:
+        return np.empty(0), np.empty(0)
+
+    src = osr.SpatialReference(wkt=projection)
+    dst = osr.SpatialReference()
+    dst.ImportFromEPSG(4326)
+    transform = osr.CoordinateTransformation(_traditionalAxisOrder(src),
+                                             _traditionalAxisOrder(dst))
+
+    lon_lat = np.asarray(transform.TransformPoints(np.column_stack([x, y]).tolist()))
+    return lon_lat[:, 0], lon_lat[:, 1]
+
+def worldToPixel(geo_transform, x, y):
+    '''
+    Inverts the full affine geo_transform (including the rotation terms):
+    returns float (pixel, line) arrays for world coordinates x, y.
+    '''
+    ulX, xDist, rtnX, ulY, rtnY, yDist = geo_transform
+    dx = np.asarray(x, dtype=np.float64) - ulX
+    dy = np.asarray(y, dtype=np.float64) - ulY
+    det = xDist * yDist - rtnX * rtnY
+    pixel = (yDist * dx - rtnX * dy) / det
+    line = (xDist * dy - rtnY * dx) / det
+    return pixel, line
+
+def lonLatToPixel(lon, lat, geo_transform, projection=None):
+    '''
+    Projects arrays of WGS84 lon/lat to integer (pixel, line) arrays of the
+    raster described by geo_transform and projection.
+    '''
+    x, y = lonLatToWorld(lon, lat, projection)
+    pixel, line = worldToPixel(geo_transform, x, y)
+    return np.floor(pixel).astype(np.int64), np.floor(line).astype(np.int64)
@@ -1,3 +1,4 @@
+from __future__ import division
 import sys
 import pdb
 
@@ -60,6 +61,8 @@ class Polygon:
                 inside = not inside
                 continue
 
+            # True division: with the integer vertices of getPolygons, Python 2
+            # would floor the slopes and misplace the edges
             try:
                 m_edge = (B.y - A.y) / (B.x - A.x)
             except ZeroDivisionError:
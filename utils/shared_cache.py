@@ -0,0 +1,106 @@
+import ctypes
+import multiprocessing
+import numpy as np
+
+class SharedImageCache(object):
+    '''
+    Bounded LRU cache of decoded (image, label) examples in shared memory.
+
+    All the buffers are allocated when the cache is created, so it must be
+    created before the data loading processes are forked (as it is when it
+    is attached to the dataset passed to MultiprocessIterator); every
+    process then reads and fills the same slots. A decoded image is paid for
+    once per run instead of once per epoch per worker.
+    '''
+
+    def __init__(self, num_examples, image_shape, max_bytes, dtype=np.float32):
+        '''
+        num_examples: length of the dataset
+        image_shape: shape of every image (the cache has fixed-size slots)
+        max_bytes: memory of the image slots
+        dtype: dtype the images are stored with
+        '''
+        self.image_shape = tuple(image_shape)
+        self.dtype = np.dtype(dtype)
+        slot_size = int(np.prod(self.image_shape))
+        self.num_slots = max(1, min(num_examples, int(max_bytes // (slot_size * self.dtype.itemsize))))
+
+        self._data = multiprocessing.RawArray(ctypes.c_char, self.num_slots * slot_size * self.dtype.itemsize)
+        self._labels = multiprocessing.RawArray(ctypes.c_int64, self.num_slots)
+        self._owner = multiprocessing.RawArray(ctypes.c_int64, self.num_slots)
+        self._used = multiprocessing.RawArray(ctypes.c_int64, self.num_slots)
+        self._slot_of = multiprocessing.RawArray(ctypes.c_int64, num_examples)
+        self._clock = multiprocessing.RawValue(ctypes.c_int64, 0)
+        self._hits = multiprocessing.RawValue(ctypes.c_int64, 0)
+        self._misses = multiprocessing.RawValue(ctypes.c_int64, 0)
+        self._lock = multiprocessing.Lock()
+
+        self.owner[:] = -1
+        self.slot_of[:] = -1
+
+    # numpy views are rebuilt on access: they must point to the shared
+    # buffers of the current process
+    @property
+    def data(self):
+        return np.frombuffer(self._data, dtype=self.dtype).reshape((self.num_slots,) + self.image_shape)
+
+    @property
+    def labels(self):
+        return np.frombuffer(self._labels, dtype=np.int64)
+
+    @property
+    def owner(self):
+        return np.frombuffer(self._owner, dtype=np.int64)
+
+    @property
+    def used(self):
+        return np.frombuffer(self._used, dtype=np.int64)
+
+    @property
+    def slot_of(self):
+        return np.frombuffer(self._slot_of, dtype=np.int64)
+
+    def _tick(self, slot):
+        self._clock.value += 1
+        self.used[slot] = self._clock.value
+
+    def get(self, i):
+        ''' Returns a copy of the cached (image, label) of example i, or None '''
+        with self._lock:
+            slot = self.slot_of[i]
+            if slot < 0:
+                self._misses.value += 1
+                return None
+            self._hits.value += 1
+            self._tick(slot)
+            return self.data[slot].copy(), self.labels[slot]
+
+    def put(self, i, image, label):
+        ''' Stores example i, evicting the least recently used one if full '''
+        if image.shape != self.image_shape:
+            return
+        with self._lock:
+            if self.slot_of[i] >= 0:
+                return
+            slot = int(np.argmin(self.used))
+            old = self.owner[slot]
+            if old >= 0:
+                self.slot_of[old] = -1
+            self.data[slot] = image
+            self.labels[slot] = label
+            self.owner[slot] = i
+            self.slot_of[i] = slot
+            self._tick(slot)
+
+    @property
+    def hits(self):
+        return self._hits.value
+
+    @property
+    def misses(self):
+        return self._misses.value
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.
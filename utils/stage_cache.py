@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import types
+
+# Default location of the artifact cache, shared by all the steps
+default_folder = os.environ.get('PARKOPEDIA_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'parkopedia'))
+
+_index_name = 'index.json'
+_hashes_name = 'file_hashes.json'
+
+def _treeFiles(path):
+    ''' The files of path (itself if it is a file), sorted '''
+    if not os.path.isdir(path):
+        return [path]
+    files = []
+    for folder, dirs, names in os.walk(path):
+        dirs.sort()
+        files.extend(os.path.join(folder, name) for name in sorted(names))
+    return files
+
+def _treeBytes(path):
+    return sum(os.path.getsize(f) for f in _treeFiles(path))
+
+def _copyTree(src, dst):
+    '''
+    Copies a file or directory. Files are copied, not hard-linked: the steps
+    overwrite their outputs in place, which would change the cached copy.
+    '''
+    if os.path.isdir(src):
+        shutil.copytree(src, dst)
+    else:
+        shutil.copy2(src, dst)
+
+def shapefileParts(shp_path):
+    ''' The files of an ESRI shapefile: .shp, .shx, .dbf and .prj '''
+    base = os.path.splitext(shp_path)[0]
+    return [base + ext for ext in ('.shp', '.shx', '.dbf', '.prj') if os.path.exists(base + ext)]
+
+def sourceFiles(script_path, namespace):
+    '''
+    The source of a step: the script and the utils modules it uses, found
+    among the values of its namespace (e.g. globals()) and followed through
+    their own imports, so that changing the code of a step invalidates its
+    cached outputs.
+    '''
+    isUtils = lambda value: isinstance(value, types.ModuleType) and value.__name__.startswith('utils.')
+    modules = {}
+    pending = [value for value in namespace if isUtils(value)]
+    while pending:
+        module = pending.pop()
+        if module.__name__ not in modules:
+            modules[module.__name__] = module
+            pending.extend(value for value in vars(module).values() if isUtils(value))
+    files = [os.path.abspath(script_path)]
+    for name in sorted(modules):
+        files.append(os.path.splitext(os.path.abspath(modules[name].__file__))[0] + '.py')
+    return files
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+class StageCache(object):
+    '''
+    Content-addressed cache of the outputs of the pipeline steps.
+
+    A step computes the fingerprint of its inputs (file contents) and
+    parameters; if an entry with that key exists its outputs are restored
+    instead of recomputed. Entries are directories holding the output files
+    and folders; the cache is kept under max_bytes by evicting the least
+    recently used entries.
+    '''
+
+    def __init__(self, folder=None, max_bytes=20 * 2**30):
+        '''
+        folder: cache directory (default: $PARKOPEDIA_CACHE or ~/.cache/parkopedia)
+        max_bytes: total size of the cached entries
+        '''
+        self.folder = folder or default_folder
+        self.max_bytes = max_bytes
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        self._hashes = self._load(_hashes_name)
+
+    def _load(self, name):
+        try:
+            with open(os.path.join(self.folder, name)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, name, data):
+        # Written to a temporary file and renamed: readers never see half a file
+        fd, tmp = tempfile.mkstemp(dir=self.folder)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, os.path.join(self.folder, name))
+
+    def fileHash(self, path):
+        '''
+        sha1 of a file's content. Hashes are remembered by (path, size,
+        mtime), so an unchanged multi-GB geotiff is only read once.
+        '''
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime]
+        known = self._hashes.get(path)
+        if known is not None and known[0] == stamp:
+            return known[1]
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                digest.update(chunk)
+        self._hashes[path] = [stamp, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def fingerprint(self, stage, inputs, params):
+        '''
+        Key of a stage run: the stage name, the content of every input file
+        (directories are walked) and the json-serializable params. Missing
+        inputs are skipped.
+        '''
+        digest = hashlib.sha1(stage.encode('utf-8'))
+        for path in inputs:
+            if not os.path.exists(path):
+                continue
+            for f in _treeFiles(path):
+                # Inside a directory the file names are content too
+                digest.update(os.path.relpath(f, path).encode('utf-8'))
+                digest.update(self.fileHash(f).encode('ascii'))
+        digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+        self._save(_hashes_name, self._hashes)
+        return digest.hexdigest()
+
+    def fetch(self, key, outputs):
+        '''
+        Restores the outputs (file or directory paths) cached under key,
+        replacing the existing ones. Returns False on a cache miss.
+        '''
+        entry = os.path.join(self.folder, key)
+        index = self._load(_index_name)
+        if key not in index or not os.path.isdir(entry):
+            return False
+        if len(index[key]['outputs']) != len(outputs):
+            return False
+        for i, path in enumerate(outputs):
+            _remove(path)
+            _copyTree(os.path.join(entry, str(i)), path)
+        index[key]['last_used'] = time.time()
+        self._save(_index_name, index)
+        return True
+
+    def store(self, key, outputs):
+        '''
+        Caches the outputs under key, then evicts the least recently used
+        entries until the cache fits in max_bytes. Outputs larger than the
+        whole cache are not stored.
+        '''
+        size = sum(_treeBytes(path) for path in outputs)
+        if size > self.max_bytes:
+            return
+        tmp = tempfile.mkdtemp(dir=self.folder)
+        # Outputs are stored by position: they can be restored under other names
+        for i, path in enumerate(outputs):
+            _copyTree(path, os.path.join(tmp, str(i)))
+        entry = os.path.join(self.folder, key)
+        _remove(entry)
+        os.rename(tmp, entry)
+
+        index = self._load(_index_name)
+        index[key] = {'bytes': size, 'last_used': time.time(),
+                      'outputs': [os.path.basename(os.path.normpath(p)) for p in outputs]}
+        total = sum(e['bytes'] for e in index.values())
+        for old in sorted(index, key=lambda k: index[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if old == key:
+                continue
+            total -= index.pop(old)['bytes']
+            _remove(os.path.join(self.folder, old))
+        self._save(_index_name, index)
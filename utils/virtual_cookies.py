@@ -0,0 +1,108 @@
+import json
+import os
+import numpy as np
+
+from utils import cookie_writer
+from utils import window_counts
+
+# A virtual cookie directory holds:
+#   virtual.json  scene path and cookie_size
+#   records.txt   one "line pixel label" record per cookie; any other text
+#                 file of records in the same directory is a subset of it
+#                 (e.g. the training and validation lists)
+header_name = 'virtual.json'
+records_name = 'records.txt'
+
+def gridRecords(image_shape, parking_matrix, cookie_size, stride, threshold_pixels, offset=0):
+    '''
+    Returns the (line, pixel, label) records of every cookie of the grid that
+    extractCookies walks, as an int (N x 3) array, labeled from the parking
+    pixels counted strip by strip (see window_counts.gridCounts).
+    '''
+    line_starts = np.arange(offset, image_shape[0] - cookie_size, stride)
+    pixel_starts = np.arange(offset, image_shape[1] - cookie_size, stride)
+    labels = window_counts.gridCounts(parking_matrix, line_starts, pixel_starts, cookie_size) >= threshold_pixels
+    lines, pixels = np.meshgrid(line_starts, pixel_starts, indexing='ij')
+    return np.column_stack([lines.ravel(), pixels.ravel(), labels.ravel()]).astype(np.int64)
+
+def balanceRecords(records, negative_ratio=1, seed=None):
+    '''
+    Keeps every positive record and negative_ratio random negatives per
+    positive, interleaved (negatives first) like saveImages writes them.
+    '''
+    positive = records[records[:, 2] == 1]
+    negative = records[records[:, 2] == 0]
+    rng = np.random.RandomState(seed)
+    negative = negative[rng.permutation(len(negative))[:int(negative_ratio * len(positive))]]
+
+    chosen = []
+    per_positive = int(np.ceil(negative_ratio)) if len(positive) else 0
+    for idx in range(len(positive)):
+        chosen.extend(negative[idx * per_positive:(idx + 1) * per_positive])
+        chosen.append(positive[idx])
+    chosen.extend(negative[len(positive) * per_positive:])
+    return np.array(chosen, dtype=np.int64).reshape(-1, 3)
+
+def saveVirtual(path, scene_path, cookie_size, records):
+    ''' Writes a virtual cookie directory: no image is written '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+    with open(os.path.join(path, header_name), 'w') as f:
+        json.dump({'scene': os.path.abspath(scene_path), 'cookie_size': int(cookie_size)}, f)
+    np.savetxt(os.path.join(path, records_name), records, fmt='%d')
+
+def isVirtualPath(path):
+    ''' True if path is a virtual cookie directory or a record list inside one '''
+    directory = path if os.path.isdir(path) else os.path.dirname(path)
+    return os.path.exists(os.path.join(directory, header_name))
+
+def openScene(scene_path):
+    '''
+    Opens the RGB scene for windowed reads: a (lines x pixels x 3) .npy file
+    memory-mapped, or a geotiff through GeotiffReader.
+    '''
+    if scene_path.endswith('.npy'):
+        return np.load(scene_path, mmap_mode='r')
+    from utils import geotiff
+    return geotiff.GeotiffReader(scene_path)
+
+class VirtualCookieReader(object):
+    '''
+    Cookies cropped on demand from the scene: reader[i] returns the
+    (3 x size x size) uint8 cookie, scaled like the PNG cookies, and its label.
+
+    The scene is opened lazily in each process, so the reader can be handed
+    to forked data loading workers.
+    '''
+
+    def __init__(self, path):
+        directory = path if os.path.isdir(path) else os.path.dirname(path)
+        with open(os.path.join(directory, header_name)) as f:
+            header = json.load(f)
+        self.scene_path = header['scene']
+        self.cookie_size = header['cookie_size']
+        records_path = os.path.join(path, records_name) if os.path.isdir(path) else path
+        self.records = np.loadtxt(records_path, dtype=np.int64, ndmin=2).reshape(-1, 3)
+        self._scene = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_scene'] = None
+        state['_pid'] = None
+        return state
+
+    @property
+    def scene(self):
+        if self._scene is None or self._pid != os.getpid():
+            self._scene = openScene(self.scene_path)
+            self._pid = os.getpid()
+        return self._scene
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        line, pixel, label = self.records[i]
+        cookie = self.scene[line:line + self.cookie_size, pixel:pixel + self.cookie_size]
+        return cookie_writer.scaleCookie(np.asarray(cookie)).transpose(2, 0, 1), label
@@ -0,0 +1,39 @@
+import numpy as np
+
+def _addRows(column_counts, matrix, start, stop, sign, chunk_lines):
+    ''' Adds (sign=1) or removes (sign=-1) the non-zero cells of rows [start, stop) '''
+    for chunk in range(start, stop, chunk_lines):
+        rows = np.asarray(matrix[chunk:min(chunk + chunk_lines, stop)]) != 0
+        column_counts += sign * rows.sum(axis=0, dtype=np.int64)
+
+def gridCounts(matrix, line_starts, pixel_starts, height, width=None, chunk_lines=1024):
+    '''
+    Number of non-zero cells of every window [line, line+height) x [pixel, pixel+width)
+    of a grid, clipped to the matrix: returns an array of shape
+    (len(line_starts), len(pixel_starts)). Only the strip of rows of each line start
+    is counted, as the number of non-zero cells per column, updated from one strip to
+    the next (every row is read twice when the line starts increase). The memory is a
+    line of counts and chunk_lines rows of the matrix.
+    '''
+    if width is None:
+        width = height
+    lines, pixels = matrix.shape[:2]
+    p0 = np.clip(pixel_starts, 0, pixels)
+    p1 = np.clip(np.add(pixel_starts, width), 0, pixels)
+    counts = np.zeros((len(line_starts), len(p0)), dtype=np.int64)
+    column_counts = np.zeros(pixels, dtype=np.int64)
+    cumulative = np.zeros(pixels + 1, dtype=np.int64)
+    # column_counts holds the rows [top, bottom)
+    top = bottom = 0
+    for i, line in enumerate(line_starts):
+        l0 = min(max(line, 0), lines)
+        l1 = min(max(line + height, 0), lines)
+        if l0 < top or l0 > bottom or l1 < bottom:
+            column_counts[:] = 0
+            top = bottom = l0
+        _addRows(column_counts, matrix, top, l0, -1, chunk_lines)
+        _addRows(column_counts, matrix, bottom, l1, 1, chunk_lines)
+        top, bottom = l0, l1
+        np.cumsum(column_counts, out=cumulative[1:])
+        counts[i] = cumulative[p1] - cumulative[p0]
+    return counts